@@ -0,0 +1,81 @@
+"""
+Gunicorn server profile: gunicorn wsgi --chdir ./src/ -c gunicorn.conf.py
+
+GUNICORN_PROFILE picks the worker class, the counts derive from the CPUs:
+    gthread (default)  CPU + 1 workers x 4 threads. A request waiting on the
+                       database or Stripe holds a thread, not the worker.
+    sync               2 x CPU + 1 workers, one request at a time each.
+    gevent             CPU workers x 1000 greenlets, needs gevent (and
+                       psycogreen for psycopg2).
+WEB_CONCURRENCY, GUNICORN_THREADS and GUNICORN_CONNECTIONS override the counts.
+
+The app is imported once in the master (preload_app) and the workers are
+forked from it; every worker then drops the database connections inherited
+from the master. `flask bench server` compares the profiles.
+"""
+import multiprocessing
+import os
+import shutil
+
+profile = os.getenv("GUNICORN_PROFILE", "gthread")
+if profile not in ("sync", "gthread", "gevent"):
+    raise RuntimeError(f"Unknown GUNICORN_PROFILE {profile!r}, use sync, gthread or gevent")
+
+if profile == "gevent":
+    # before the app (and its sockets, ssl, threads) is imported by preload_app
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+cpus = multiprocessing.cpu_count()
+# a small instance is memory bound before it is CPU bound
+max_workers = int(os.getenv("GUNICORN_MAX_WORKERS", 8))
+
+if profile == "sync":
+    worker_class = "sync"
+    workers = 2 * cpus + 1
+elif profile == "gthread":
+    worker_class = "gthread"
+    workers = cpus + 1
+    threads = int(os.getenv("GUNICORN_THREADS", 4))
+else:
+    worker_class = "gevent"
+    workers = cpus
+    worker_connections = int(os.getenv("GUNICORN_CONNECTIONS", 1000))
+workers = int(os.getenv("WEB_CONCURRENCY", min(workers, max_workers)))
+
+preload_app = True
+# recycle the workers now and then, the jitter keeps them from restarting together
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+# longer than the idle timeout of the proxy in front, so it is the proxy that closes
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 75))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 30
+# the heartbeat file on tmpfs, a slow disk cannot get a healthy worker killed
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+# /metrics aggregates the samples of every worker from this directory, stale files of
+# a previous run would be added to the new counters
+multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if multiproc_dir:
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # connections opened in the master are shared with it, the worker must open its own
+    from app import app
+    from api.models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from api.metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -0,0 +1,56 @@
+"""stripe webhook events and order lines
+
+Revision ID: a1d5e9c3f7b2
+Revises: f2c6a8e4b1d7
+Create Date: 2026-10-18 19:47:12.880341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1d5e9c3f7b2'
+down_revision = 'f2c6a8e4b1d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stripe_events',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('type', sa.String(length=100), nullable=False),
+    sa.Column('status', sa.Enum('received', 'processed', 'ignored', 'failed', name='stripe_event_status'), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('error', sa.String(length=500), nullable=True),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('received_at', sa.DateTime(), nullable=False),
+    sa.Column('processed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('stripe_events', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stripe_events_status'), ['status'], unique=False)
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('stripe_session_id', sa.String(length=255), nullable=True))
+        batch_op.create_unique_constraint('uq_orders_stripe_session_id', ['stripe_session_id'])
+
+    with op.batch_alter_table('products_in_order', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('quantity', sa.Integer(), server_default='1', nullable=False))
+        batch_op.add_column(sa.Column('price', sa.Double(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('products_in_order', schema=None) as batch_op:
+        batch_op.drop_column('price')
+        batch_op.drop_column('quantity')
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_orders_stripe_session_id', type_='unique')
+        batch_op.drop_column('stripe_session_id')
+
+    with op.batch_alter_table('stripe_events', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_stripe_events_status'))
+
+    op.drop_table('stripe_events')
+    sa.Enum(name='stripe_event_status').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,30 @@
+"""products keyset pagination indexes
+
+Revision ID: a3f1c9d2e7b4
+Revises: 4dddc4805abb
+Create Date: 2026-10-18 15:20:11.402318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c9d2e7b4'
+down_revision = '4dddc4805abb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.create_index('ix_products_price_id', ['price', 'id'], unique=False)
+        batch_op.create_index('ix_products_brand_price_id', ['brand', 'price', 'id'], unique=False)
+        batch_op.create_index('ix_products_type_price_id', ['type', 'price', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_index('ix_products_type_price_id')
+        batch_op.drop_index('ix_products_brand_price_id')
+        batch_op.drop_index('ix_products_price_id')
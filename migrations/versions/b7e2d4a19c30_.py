@@ -0,0 +1,31 @@
+"""catalog version counter
+
+Revision ID: b7e2d4a19c30
+Revises: a3f1c9d2e7b4
+Create Date: 2026-10-18 15:48:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4a19c30'
+down_revision = 'a3f1c9d2e7b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # single row, bumped by every catalog write
+    op.execute("INSERT INTO catalog_version (id, version, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP)")
+
+
+def downgrade():
+    op.drop_table('catalog_version')
@@ -0,0 +1,161 @@
+"""integer stock and stock holds
+
+Revision ID: b8e3f1a6c2d4
+Revises: a1d5e9c3f7b2
+Create Date: 2026-10-18 20:31:05.116842
+
+On PostgreSQL the conversion is done online: a new integer column is kept in
+sync by a trigger while the existing rows are converted in short batches,
+then the columns are swapped. Only the final swap takes an exclusive lock,
+and it does not rewrite or scan the table. SQLite rebuilds the table, which
+drops the products_fts triggers of c4d8e1f6a2b9: they are created again and
+the search index rebuilt, after the upgrade and after the downgrade.
+Values that are not a whole number become 0.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e3f1a6c2d4'
+down_revision = 'a1d5e9c3f7b2'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 5000
+
+PG_STOCK_AS_INTEGER = "CASE WHEN {column} ~ '^\\s*[0-9]{{1,9}}\\s*$' THEN trim({column})::integer ELSE 0 END"
+
+
+def upgrade_postgresql():
+    bind = op.get_bind()
+    op.add_column('products', sa.Column('stock_int', sa.Integer(), nullable=True))
+    op.execute(f"""
+        CREATE FUNCTION products_stock_int_sync() RETURNS trigger AS $$
+        BEGIN
+            NEW.stock_int := {PG_STOCK_AS_INTEGER.format(column='NEW.stock')};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute(
+        "CREATE TRIGGER products_stock_int_sync BEFORE INSERT OR UPDATE OF stock ON products "
+        "FOR EACH ROW EXECUTE FUNCTION products_stock_int_sync()"
+    )
+
+    # every batch commits on its own, writers only wait for the rows of the current batch
+    with op.get_context().autocommit_block():
+        while True:
+            converted = bind.execute(sa.text(
+                f"UPDATE products SET stock_int = {PG_STOCK_AS_INTEGER.format(column='stock')} "
+                "WHERE id IN (SELECT id FROM products WHERE stock_int IS NULL LIMIT :batch_size)"
+            ), {'batch_size': BACKFILL_BATCH_SIZE}).rowcount
+            if not converted:
+                break
+        # validated without blocking writes, then SET NOT NULL can trust it instead of scanning
+        bind.execute(sa.text(
+            "ALTER TABLE products ADD CONSTRAINT ck_products_stock_int_not_null CHECK (stock_int IS NOT NULL) NOT VALID"
+        ))
+        bind.execute(sa.text("ALTER TABLE products VALIDATE CONSTRAINT ck_products_stock_int_not_null"))
+        bind.execute(sa.text(
+            "ALTER TABLE products ADD CONSTRAINT ck_products_stock_non_negative CHECK (stock_int >= 0) NOT VALID"
+        ))
+        bind.execute(sa.text("ALTER TABLE products VALIDATE CONSTRAINT ck_products_stock_non_negative"))
+
+    op.execute("ALTER TABLE products ALTER COLUMN stock_int SET NOT NULL")
+    op.execute("ALTER TABLE products DROP CONSTRAINT ck_products_stock_int_not_null")
+    op.execute("DROP TRIGGER products_stock_int_sync ON products")
+    op.execute("DROP FUNCTION products_stock_int_sync()")
+    op.drop_column('products', 'stock')
+    op.alter_column('products', 'stock_int', new_column_name='stock', server_default='0')
+
+
+def upgrade_sqlite():
+    op.execute(
+        "UPDATE products SET stock = CASE WHEN trim(stock) != '' AND trim(stock) NOT GLOB '*[^0-9]*' "
+        "AND length(trim(stock)) <= 9 THEN CAST(trim(stock) AS INTEGER) ELSE 0 END"
+    )
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.alter_column('stock',
+               existing_type=sa.String(length=120),
+               type_=sa.Integer(),
+               existing_nullable=False,
+               server_default='0')
+        batch_op.create_check_constraint('ck_products_stock_non_negative', 'stock >= 0')
+    restore_sqlite_search()
+
+
+def restore_sqlite_search():
+    # the rebuilt products table lost its triggers, the FTS table itself is still there
+    has_search = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+    )).scalar()
+    if not has_search:
+        return
+    # the triggers of c4d8e1f6a2b9, as they were at this revision
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, name, description, brand)
+            VALUES (new.id, new.name, new.description, new.brand);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+            VALUES ('delete', old.id, old.name, old.description, old.brand);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, description, brand ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+            VALUES ('delete', old.id, old.name, old.description, old.brand);
+            INSERT INTO products_fts(rowid, name, description, brand)
+            VALUES (new.id, new.name, new.description, new.brand);
+        END
+    """)
+    op.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        upgrade_postgresql()
+    else:
+        upgrade_sqlite()
+
+    op.create_table('stock_holds',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('checkout_job_id', sa.String(length=36), nullable=True),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Enum('held', 'committed', 'released', name='stock_hold_status'), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['checkout_job_id'], ['checkout_jobs.id'], ),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('stock_holds', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stock_holds_checkout_job_id'), ['checkout_job_id'], unique=False)
+        batch_op.create_index('ix_stock_holds_status_expires_at', ['status', 'expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('stock_holds', schema=None) as batch_op:
+        batch_op.drop_index('ix_stock_holds_status_expires_at')
+        batch_op.drop_index(batch_op.f('ix_stock_holds_checkout_job_id'))
+
+    op.drop_table('stock_holds')
+    sa.Enum(name='stock_hold_status').drop(op.get_bind(), checkfirst=True)
+
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_constraint('ck_products_stock_non_negative', type_='check')
+        batch_op.alter_column('stock',
+               existing_type=sa.Integer(),
+               type_=sa.String(length=120),
+               existing_nullable=False,
+               server_default=None,
+               postgresql_using='stock::varchar')
+    if op.get_bind().dialect.name == 'sqlite':
+        restore_sqlite_search()
@@ -0,0 +1,73 @@
+"""products full-text search
+
+Revision ID: c4d8e1f6a2b9
+Revises: b7e2d4a19c30
+Create Date: 2026-10-18 16:22:05.730941
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8e1f6a2b9'
+down_revision = 'b7e2d4a19c30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # generated column, postgres keeps it in sync on every insert/update
+        op.execute("""
+            ALTER TABLE products ADD COLUMN search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('spanish', coalesce(name, '')), 'A') ||
+                setweight(to_tsvector('spanish', coalesce(brand, '')), 'B') ||
+                setweight(to_tsvector('spanish', coalesce(description, '')), 'C')
+            ) STORED
+        """)
+        op.execute("CREATE INDEX ix_products_search_vector ON products USING gin (search_vector)")
+    elif dialect == 'sqlite':
+        # external-content FTS5 table, the triggers maintain it row by row
+        op.execute("""
+            CREATE VIRTUAL TABLE products_fts USING fts5(
+                name, description, brand,
+                content='products', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        op.execute("""
+            CREATE TRIGGER products_fts_ai AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts(rowid, name, description, brand)
+                VALUES (new.id, new.name, new.description, new.brand);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER products_fts_ad AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+                VALUES ('delete', old.id, old.name, old.description, old.brand);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER products_fts_au AFTER UPDATE OF name, description, brand ON products BEGIN
+                INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+                VALUES ('delete', old.id, old.name, old.description, old.brand);
+                INSERT INTO products_fts(rowid, name, description, brand)
+                VALUES (new.id, new.name, new.description, new.brand);
+            END
+        """)
+        op.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_products_search_vector")
+        op.execute("ALTER TABLE products DROP COLUMN IF EXISTS search_vector")
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS products_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS products_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS products_fts_ai")
+        op.execute("DROP TABLE IF EXISTS products_fts")
@@ -0,0 +1,69 @@
+"""indexes for the hot lookups: unique favorites (user_id, product_id) and the foreign keys
+
+Revision ID: c6f2a9d4e1b3
+Revises: b8e3f1a6c2d4
+Create Date: 2026-10-18 22:14:37.508126
+
+shopping_cart (user_id, product_id) is already covered by the unique
+constraint of d9a7b3c5e812. On PostgreSQL the indexes are built with CREATE
+INDEX CONCURRENTLY, outside a transaction, so the tables keep taking writes
+while they build; an invalid index left by an interrupted build is dropped
+and built again.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f2a9d4e1b3'
+down_revision = 'b8e3f1a6c2d4'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns, unique)
+INDEXES = [
+    ('uq_favorites_user_product', 'favorites', ['user_id', 'product_id'], True),
+    ('ix_checkout_user_id', 'checkout', ['user_id'], False),
+    ('ix_checkout_order_id', 'checkout', ['order_id'], False),
+    ('ix_products_in_order_order_id', 'products_in_order', ['order_id'], False),
+    ('ix_products_in_order_product_id', 'products_in_order', ['product_id'], False),
+    ('ix_products_user_id', 'products', ['user_id'], False),
+]
+
+
+def create_indexes_postgresql():
+    bind = op.get_bind()
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            invalid = bind.execute(sa.text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ), {'name': name}).scalar()
+            if invalid:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True, if_not_exists=True)
+
+
+def upgrade():
+    # the same product toggled twice at once could be stored twice, keep the oldest row
+    op.execute("""
+        DELETE FROM favorites WHERE id NOT IN (
+            SELECT MIN(id) FROM favorites GROUP BY user_id, product_id
+        )
+    """)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        create_indexes_postgresql()
+    else:
+        for name, table, columns, unique in INDEXES:
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns, unique in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, table, columns, unique in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
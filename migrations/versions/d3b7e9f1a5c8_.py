@@ -0,0 +1,29 @@
+"""unit price of the stock holds
+
+Revision ID: d3b7e9f1a5c8
+Revises: c6f2a9d4e1b3
+Create Date: 2026-10-18 23:05:41.270318
+
+The paid order is built from the holds of its checkout, at the price they
+were taken at. Holds taken before this revision have no price, their order
+lines use the current price of the product.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3b7e9f1a5c8'
+down_revision = 'c6f2a9d4e1b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('stock_holds', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('price', sa.Double(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('stock_holds', schema=None) as batch_op:
+        batch_op.drop_column('price')
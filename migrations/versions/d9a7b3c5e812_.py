@@ -0,0 +1,42 @@
+"""unique shopping_cart (user_id, product_id)
+
+Revision ID: d9a7b3c5e812
+Revises: c4d8e1f6a2b9
+Create Date: 2026-10-18 17:05:44.281573
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9a7b3c5e812'
+down_revision = 'c4d8e1f6a2b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # merge the duplicated lines left by the old read-modify-write path into the oldest one
+    op.execute("""
+        UPDATE shopping_cart SET quantity = (
+            SELECT SUM(duplicate.quantity) FROM shopping_cart AS duplicate
+            WHERE duplicate.user_id = shopping_cart.user_id
+            AND duplicate.product_id = shopping_cart.product_id
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM shopping_cart GROUP BY user_id, product_id HAVING COUNT(*) > 1
+        )
+    """)
+    op.execute("""
+        DELETE FROM shopping_cart WHERE id NOT IN (
+            SELECT MIN(id) FROM shopping_cart GROUP BY user_id, product_id
+        )
+    """)
+    with op.batch_alter_table('shopping_cart', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_shopping_cart_user_product', ['user_id', 'product_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('shopping_cart', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_shopping_cart_user_product', type_='unique')
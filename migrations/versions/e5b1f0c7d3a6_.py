@@ -0,0 +1,42 @@
+"""checkout jobs
+
+Revision ID: e5b1f0c7d3a6
+Revises: d9a7b3c5e812
+Create Date: 2026-10-18 18:10:26.554108
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b1f0c7d3a6'
+down_revision = 'd9a7b3c5e812'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('checkout_jobs',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('idempotency_key', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.Enum('pending', 'complete', 'failed', name='checkout_job_status'), nullable=False),
+    sa.Column('stripe_session_id', sa.String(length=255), nullable=True),
+    sa.Column('checkout_url', sa.String(length=1000), nullable=True),
+    sa.Column('error', sa.String(length=500), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('checkout_jobs', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_checkout_jobs_idempotency_key'), ['idempotency_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('checkout_jobs', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_checkout_jobs_idempotency_key'))
+
+    op.drop_table('checkout_jobs')
+    sa.Enum(name='checkout_job_status').drop(op.get_bind(), checkfirst=True)
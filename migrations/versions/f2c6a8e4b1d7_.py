@@ -0,0 +1,30 @@
+"""stripe price ids on products
+
+Revision ID: f2c6a8e4b1d7
+Revises: e5b1f0c7d3a6
+Create Date: 2026-10-18 19:02:41.307215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c6a8e4b1d7'
+down_revision = 'e5b1f0c7d3a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('stripe_product_id', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('stripe_price_id', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('stripe_price_amount', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_column('stripe_price_amount')
+        batch_op.drop_column('stripe_price_id')
+        batch_op.drop_column('stripe_product_id')
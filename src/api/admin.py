@@ -1,18 +1,44 @@
-  
+"""
+The Flask-Admin of the models at /admin, built on its first request.
+
+Flask-Admin and its SQLAlchemy views are slow to import and only a few
+people ever open the admin, so setup_admin puts a WSGI dispatcher in front
+of the app instead: the admin (a small Flask app of its own, Flask does not
+accept new routes once an app is serving) is created the first time a
+request for /admin arrives. ADMIN_ENABLED=0 turns it off.
+"""
 import os
-from flask_admin import Admin
-from .models import db, User, Products, Orders, ProductsInOrder, Checkout, ShoppingCart, Favorites
-from flask_admin.contrib.sqla import ModelView
+import threading
+from flask import Flask
+from .models import db
 
-def setup_admin(app):
-    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
-    app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+ADMIN_PREFIX = '/admin'
+
+
+def create_admin_app(config):
+    from flask_admin import Admin
+    from flask_admin.contrib.sqla import ModelView
+    from .models import User, Products, Orders, ProductsInOrder, Checkout, ShoppingCart, Favorites
+    from .catalog import bump_catalog_version
+
+    class ProductsView(ModelView):
+        # run before the admin's commit, the new catalog version lands in the same transaction
+        # and the cached catalog and its ETags are invalidated once it commits
+        def on_model_change(self, form, model, is_created):
+            bump_catalog_version()
+
+        def on_model_delete(self, model):
+            bump_catalog_version()
+
+    app = Flask(__name__)
+    app.config.update(config)
+    app.secret_key = config['SECRET_KEY']
+    db.init_app(app)
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Products, db.session))
+    admin.add_view(ProductsView(Products, db.session))
     admin.add_view(ModelView(Orders, db.session))
     admin.add_view(ModelView(ProductsInOrder, db.session))
     admin.add_view(ModelView(Checkout, db.session))
@@ -20,4 +46,34 @@ def setup_admin(app):
     admin.add_view(ModelView(Favorites, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
+    return app
+
+
+class LazyAdmin:
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def get_admin_app(self):
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    self.admin_app = create_admin_app(self.app.config)
+        return self.admin_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == ADMIN_PREFIX or path.startswith(ADMIN_PREFIX + '/'):
+            return self.get_admin_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def setup_admin(app):
+    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
+    app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+    if os.getenv('ADMIN_ENABLED', '1') != '1':
+        return
+    app.wsgi_app = LazyAdmin(app, app.wsgi_app)
@@ -0,0 +1,214 @@
+"""
+Static files of the frontend, served from a manifest built once per process,
+on the first request or asset_url() that needs it (not at startup: it
+fingerprints every file of the directory).
+
+Every file of the static directory gets a fingerprinted URL
+(bundle.js -> /bundle.3f9a1c2b7d.js, whatever the bundler named it) that is
+cached for a year as immutable.
+index.html is rewritten to point at those URLs and is never cached without
+revalidation. The plain names keep working for the URLs built by the bundle
+(/img/...) and are revalidated with their ETag. When a file has .br / .gz siblings (`flask compress-assets`), the one the
+client accepts is sent with Content-Encoding.
+
+Requests never touch the filesystem to find out whether a file exists.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from flask import request, send_file, make_response
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".txt", ".map", ".ico", ".xml", ".wasm"}
+MIN_COMPRESS_SIZE = 1024
+# src="/bundle.js", href="./4geeks.ico"; absolute URLs are left alone
+LOCAL_REFERENCE = re.compile(r'''(?P<attr>\b(?:src|href)=["'])(?:\./|/)?(?P<path>[^"':?#]+)(?P<end>["'])''')
+
+
+class Asset:
+    def __init__(self, path, url, hashed):
+        self.path = path
+        self.url = url
+        self.hashed = hashed
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        # a sibling older than the file was compressed from a previous build
+        self.variants = {
+            encoding: path + suffix for encoding, suffix in ENCODINGS
+            if os.path.isfile(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+        }
+
+
+def file_digest(path):
+    digest = hashlib.md5(usedforsecurity=False)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:10]
+
+
+def accepted_encodings(header):
+    # "gzip, br;q=0.8, *;q=0" -> {"gzip", "br"}
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class AssetManifest:
+    def __init__(self, static_dir, index="index.html"):
+        self.static_dir = os.path.realpath(static_dir)
+        self.index = index
+        # url path (no leading slash) -> Asset, plain and fingerprinted names
+        self.files = {}
+        # plain name -> fingerprinted url
+        self.urls = {}
+        self.index_body = None
+        self.index_variants = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.scan()
+                    self.loaded = True
+        return self
+
+    def scan(self):
+        files, urls = {}, {}
+        for root, dirs, names in os.walk(self.static_dir):
+            for name in names:
+                if name.endswith((".gz", ".br")):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+                if relative == self.index:
+                    continue
+                stem, ext = os.path.splitext(relative)
+                fingerprinted = f"{stem}.{file_digest(path)}{ext}"
+                files[relative] = Asset(path, relative, hashed=False)
+                files[fingerprinted] = Asset(path, fingerprinted, hashed=True)
+                urls[relative] = fingerprinted
+        self.files, self.urls = files, urls
+        self._load_index()
+
+    def _load_index(self):
+        path = os.path.join(self.static_dir, self.index)
+        if not os.path.isfile(path):
+            self.index_body = None
+            return
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+
+        def fingerprint(match):
+            url = self.urls.get(match.group("path"))
+            if url is None:
+                return match.group(0)
+            return f"{match.group('attr')}/{url}{match.group('end')}"
+
+        self.index_body = LOCAL_REFERENCE.sub(fingerprint, html).encode("utf-8")
+        self.index_etag = hashlib.md5(self.index_body, usedforsecurity=False).hexdigest()[:16]
+        self.index_variants = {"gzip": gzip.compress(self.index_body, 9)}
+        brotli = load_brotli()
+        if brotli is not None:
+            self.index_variants["br"] = brotli.compress(self.index_body)
+
+    def url_for(self, path):
+        self.load()
+        return "/" + self.urls.get(path.lstrip("/"), path.lstrip("/"))
+
+    def send_index(self):
+        self.load()
+        if self.index_body is None:
+            return make_response(("Not found", 404))
+        body, encoding = self.index_body, None
+        accepted = accepted_encodings(request.headers.get("Accept-Encoding"))
+        for name, _ in ENCODINGS:
+            if name in accepted and name in self.index_variants:
+                body, encoding = self.index_variants[name], name
+                break
+        response = make_response(body)
+        response.mimetype = "text/html"
+        response.set_etag(f"{self.index_etag}-{encoding}" if encoding else self.index_etag)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        # the entry point: always revalidated, so a deploy is picked up on the next page view
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def send(self, path):
+        asset = self.load().files.get(path)
+        if asset is None:
+            # client side routes of the SPA
+            return self.send_index()
+
+        accepted = accepted_encodings(request.headers.get("Accept-Encoding"))
+        encoding = next((name for name, _ in ENCODINGS if name in accepted and name in asset.variants), None)
+        # without max_age send_file answers no-cache, which is what the plain names need
+        response = send_file(
+            asset.variants[encoding] if encoding else asset.path, mimetype=asset.mimetype, conditional=True,
+            max_age=IMMUTABLE_MAX_AGE if asset.hashed else None,
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if asset.variants:
+            response.vary.add("Accept-Encoding")
+        if asset.hashed:
+            response.cache_control.immutable = True
+        return response
+
+
+def load_brotli():
+    # optional, without it only the gzip variants are written
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress_assets(static_dir, min_size=MIN_COMPRESS_SIZE):
+    """Writes the .gz and .br siblings of the compressible files. Returns the number of files written"""
+    brotli = load_brotli()
+    written = 0
+    for root, dirs, names in os.walk(static_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE or os.path.getsize(path) < min_size:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            variants = {".gz": gzip.compress(data, 9)}
+            if brotli is not None:
+                variants[".br"] = brotli.compress(data, quality=11)
+            for suffix, compressed in variants.items():
+                # a variant that is not smaller is useless
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed)
+                written += 1
+    return written
+
+
+def setup_assets(app, static_dir):
+    manifest = AssetManifest(static_dir)
+    app.extensions["assets"] = manifest
+    app.jinja_env.globals["asset_url"] = manifest.url_for
+    return manifest
@@ -0,0 +1,61 @@
+"""
+Resolves the JWT identity to the current user without a query per request.
+
+flask_jwt_extended calls the user_lookup_loader once per request and keeps
+the result in the request context (current_user). The loader reads from a
+short-TTL per-worker cache of user snapshots, so an authenticated request only
+goes to the database when the user is not cached yet. update_user and
+delete_user drop that user's snapshot on commit in every worker, the other
+users stay cached.
+"""
+from flask import jsonify
+from api.models import db, User
+from api.cache import LRUTTLCache, invalidate_on_commit
+
+USERS_CHANNEL = 'users'
+
+# user id -> User.serialize() snapshot
+user_cache = LRUTTLCache('users', channel=USERS_CHANNEL, ttl=30.0)
+
+
+class UserSnapshot:
+    # read-only stand-in for User, enough for the routes that only need to know who is calling
+    def __init__(self, data):
+        self.data = data
+        self.id = data['user_id']
+        self.email = data['email']
+        self.user_name = data['user_name']
+
+    def serialize(self):
+        return dict(self.data)
+
+    def __repr__(self):
+        return f'<UserSnapshot: {self.id} - {self.email}>'
+
+
+def _load_user_data(user_id):
+    user = db.session.get(User, user_id)
+    return user.serialize() if user else None
+
+
+def load_user(identity):
+    try:
+        user_id = int(identity)
+    except (TypeError, ValueError):
+        return None
+    data = user_cache.get_or_load(user_id, lambda: _load_user_data(user_id))
+    return UserSnapshot(data) if data else None
+
+
+def invalidate_user(user_id):
+    invalidate_on_commit(USERS_CHANNEL, int(user_id))
+
+
+def setup_auth(jwt):
+    @jwt.user_lookup_loader
+    def user_lookup_callback(jwt_header, jwt_data):
+        return load_user(jwt_data['sub'])
+
+    @jwt.user_lookup_error_loader
+    def user_lookup_error_callback(jwt_header, jwt_data):
+        return jsonify({'msg': 'User not found'}), 404
@@ -0,0 +1,66 @@
+"""
+Background jobs on a per-worker thread pool, so slow outbound calls (Stripe)
+do not hold the request thread. Jobs run inside an app context and must keep
+their state in the database: the client may poll any worker.
+"""
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+
+config = {'workers': 4}
+
+_lock = threading.Lock()
+_executor = None
+_pid = None
+# submitted and not finished yet, for wait_idle
+_pending = set()
+
+
+def _pool():
+    # created on first use and again after a fork, threads do not survive it
+    global _executor, _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=config['workers'], thread_name_prefix="background")
+                _pid = os.getpid()
+    return _executor
+
+
+def submit(fn, *args, **kwargs):
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+                raise
+
+    future = _pool().submit(run)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(_done)
+    return future
+
+
+def _done(future):
+    with _lock:
+        _pending.discard(future)
+
+
+def wait_idle(timeout=None):
+    """Waits for the jobs submitted so far (benchmarks, tests), returns False on timeout"""
+    with _lock:
+        pending = list(_pending)
+    return not wait(pending, timeout=timeout).not_done
+
+
+def setup_background(app):
+    global _pid
+    app.config.setdefault('BACKGROUND_WORKERS', int(os.getenv('BACKGROUND_WORKERS', 4)))
+    config['workers'] = app.config['BACKGROUND_WORKERS']
+    _pid = None
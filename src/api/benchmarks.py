@@ -0,0 +1,892 @@
+"""
+Benchmarks and stress checks, run as `flask bench <name>` against the
+configured database. They work on their own rows (named "bench-...") so they
+can run next to real data, and print their results.
+"""
+import hashlib
+import hmac
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_jwt_extended import create_access_token
+from sqlalchemy import select, delete, update, insert, func
+from api.models import db, User, Products, ShoppingCart, StockHold, Favorites, StripeEvent, Checkout, ProductsInOrder
+from api.cart import add_to_cart
+from api.utils import APIException
+from api.passwords import hash_password
+from api.stock import reserve_stock, release_holds
+from api.compression import compress_bytes
+from api.assets import load_brotli
+from api.catalog import DEFAULT_PAGE_SIZE
+from api.json_provider import FastJSONProvider, orjson
+from api.instrumentation import count_queries
+from api.fake_stripe import start_fake_stripe
+from api.stripe_client import configure_stripe
+from api import background
+from flask.json.provider import DefaultJSONProvider
+
+bench = AppGroup("bench", help="Benchmarks and stress checks")
+
+
+def bench_user(name, password="-"):
+    user = db.session.scalar(select(User).filter_by(user_name=name))
+    if user is None:
+        user = User(user_name=name, email=f"{name}@bench.local", password=password, is_active=True,
+                    first_name="Bench", last_name=name, phone=name, address=name)
+        db.session.add(user)
+        db.session.commit()
+    return user.id
+
+
+def bench_product(name, price=10.0, stock=0):
+    product = db.session.scalar(select(Products).filter_by(name=name))
+    if product is None:
+        product = Products(name=name, description=name, img="", brand="bench", type="bench", price=price, stock=stock)
+        db.session.add(product)
+        db.session.commit()
+    return product.id
+
+
+def run_threads(count, target):
+    # all the threads start together, so they really compete
+    app = current_app._get_current_object()
+    barrier = threading.Barrier(count)
+
+    def worker(index):
+        with app.app_context():
+            barrier.wait()
+            target(index)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, statuses, elapsed):
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "statuses": dict(statuses),
+    }
+
+
+def run_load(groups, duration):
+    """
+    groups: {name: (threads, request)}, request(client) sends one request and
+    returns the response. Every thread loops until `duration` seconds are up.
+    Returns {name: summary}.
+    """
+    app = current_app._get_current_object()
+    results = {name: ([], Counter()) for name in groups}
+    lock = threading.Lock()
+    total = sum(threads for threads, _ in groups.values())
+    barrier = threading.Barrier(total)
+    deadline = []
+
+    def worker(name, request):
+        client = app.test_client()
+        latencies, statuses = [], Counter()
+        barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            started = time.perf_counter()
+            response = request(client)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+        with lock:
+            results[name][0].extend(latencies)
+            results[name][1].update(statuses)
+
+    threads = [threading.Thread(target=worker, args=(name, request))
+               for name, (count, request) in groups.items() for _ in range(count)]
+    deadline.append(time.perf_counter() + duration)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {name: summarize(latencies, statuses, duration) for name, (latencies, statuses) in results.items()}
+
+
+def print_summary(name, summary):
+    print(f"{name:>24}: {summary['requests']:6d} req {summary['throughput_rps']:8.1f} req/s  "
+          f"p50 {summary['p50_ms']} ms  p95 {summary['p95_ms']} ms  p99 {summary['p99_ms']} ms  "
+          f"statuses {summary['statuses']}")
+
+
+@bench.command("login")
+@click.option("--login-threads", default=8, show_default=True)
+@click.option("--catalog-threads", default=4, show_default=True)
+@click.option("--duration", default=10.0, show_default=True, help="Seconds")
+def login(login_threads, catalog_threads, duration):
+    """Login burst mixed with catalog reads: login and catalog p99, 429s from the hashing pool"""
+    password = "bench-password"
+    user_id = bench_user("bench-login", hash_password(password))
+    email = db.session.get(User, user_id).email
+    bench_product("bench-login-product")
+    db.session.remove()
+
+    results = run_load({
+        "POST /api/login": (login_threads, lambda client: client.post("/api/login", json={"email": email, "password": password})),
+        "GET /api/products": (catalog_threads, lambda client: client.get("/api/products")),
+    }, duration)
+    for name, summary in results.items():
+        print_summary(name, summary)
+
+
+@bench.command("cart-upsert")
+@click.option("--threads", default=8, show_default=True)
+@click.option("--iterations", default=50, show_default=True, help="Adds per thread")
+def cart_upsert(threads, iterations):
+    """Many concurrent adds of the same product to the same cart: no increment may be lost"""
+    user_id = bench_user("bench-cart")
+    product_id = bench_product("bench-cart-product")
+    db.session.execute(delete(ShoppingCart).filter_by(user_id=user_id, product_id=product_id))
+    db.session.commit()
+
+    committed = [0] * threads
+    errors = []
+
+    def add(index):
+        for _ in range(iterations):
+            try:
+                add_to_cart(user_id, product_id, 1)
+                db.session.commit()
+                committed[index] += 1
+            except Exception as error:
+                db.session.rollback()
+                errors.append(error)
+
+    elapsed = run_threads(threads, add)
+
+    final = db.session.scalar(select(ShoppingCart.quantity).filter_by(user_id=user_id, product_id=product_id)) or 0
+    expected = sum(committed)
+    print(f"{expected} committed adds in {elapsed:.2f}s ({expected / elapsed:,.0f} adds/s), {len(errors)} failed")
+    if errors:
+        print(f"first error: {errors[0]}")
+    print(f"final quantity {final}, expected {expected}, lost {expected - final}")
+    if final != expected:
+        raise SystemExit(1)
+
+
+@bench.command("stock")
+@click.option("--buyers", default=32, show_default=True, help="Concurrent buyers")
+@click.option("--stock", "units", default=500, show_default=True, help="Units of the hot product")
+@click.option("--quantity", default=1, show_default=True, help="Units per reservation")
+def stock(buyers, units, quantity):
+    """Many buyers reserving one hot product until it sells out: no unit may be sold twice"""
+    user_id = bench_user("bench-stock")
+    product_id = bench_product("bench-stock-product")
+    release_holds(StockHold.product_id == product_id)
+    db.session.execute(update(Products).filter_by(id=product_id).values(stock=units))
+    db.session.commit()
+
+    reserved = [0] * buyers
+    attempts = [0] * buyers
+    errors = []
+
+    def buy(index):
+        while True:
+            attempts[index] += 1
+            try:
+                reserve_stock(user_id, [(product_id, quantity)])
+                db.session.commit()
+                reserved[index] += quantity
+            except APIException:
+                db.session.rollback()
+                return
+            except Exception as error:
+                db.session.rollback()
+                errors.append(error)
+                if len(errors) > 100:
+                    return
+
+    elapsed = run_threads(buyers, buy)
+
+    sold = sum(reserved)
+    left = db.session.scalar(select(Products.stock).filter_by(id=product_id))
+    held = db.session.scalar(
+        select(func.coalesce(func.sum(StockHold.quantity), 0)).filter_by(product_id=product_id, status="held")
+    )
+    print(f"{sold // quantity} reservations in {elapsed:.2f}s ({sold // quantity / elapsed:,.0f} reservations/s), "
+          f"{sum(attempts)} attempts, {len(errors)} errors")
+    if errors:
+        print(f"first error: {errors[0]}")
+    oversold = max(sold - units, 0)
+    print(f"sold {sold} of {units}, left {left}, held {held}, oversold {oversold}")
+
+    # the bench holds go back, the product is ready for the next run
+    release_holds(StockHold.product_id == product_id)
+    db.session.commit()
+    if oversold or sold + left != units or held != sold:
+        raise SystemExit(1)
+
+
+def synthetic_products(count):
+    # the widest rows the columns allow: 400 char descriptions, 500 char image URLs
+    words = "cafe arabica tostado natural notas chocolate cereza origen altura proceso lavado".split()
+    return [
+        {
+            "id": index, "name": f"bench-product-{index}",
+            "description": " ".join(words[(index + i) % len(words)] for i in range(60))[:400],
+            "img": f"https://res.cloudinary.com/bench/image/upload/v{index}/products/{'x' * 420}/{index}.png"[:500],
+            "brand": words[index % len(words)], "type": words[(index * 7) % len(words)],
+            "price": round(5 + index % 40 + 0.99, 2), "stock": index % 100,
+        }
+        for index in range(count)
+    ]
+
+
+@bench.command("compression")
+@click.option("--synthetic", default=0, help="Use this many generated products instead of the catalog")
+@click.option("--repeat", default=20, show_default=True, help="Compressions per measurement")
+def compression(synthetic, repeat):
+    """Bytes saved against CPU time per encoding and level, for one catalog page and the whole catalog"""
+    if synthetic:
+        products = synthetic_products(synthetic)
+    else:
+        products = [product.serialize() for product in db.session.scalars(select(Products).order_by(Products.id))]
+        if len(products) < DEFAULT_PAGE_SIZE:
+            print(f"Only {len(products)} products in the database, using 1000 generated ones (--synthetic)")
+            products = synthetic_products(1000)
+
+    payloads = {
+        f"page ({DEFAULT_PAGE_SIZE} products)": current_app.json.dumps({"products": products[:DEFAULT_PAGE_SIZE]}).encode(),
+        f"catalog ({len(products)} products)": current_app.json.dumps(products).encode(),
+    }
+    settings = [("gzip", level, None) for level in (1, 6, 9)]
+    if load_brotli() is not None:
+        settings += [("br", None, quality) for quality in (1, 4, 6, 11)]
+    else:
+        print("brotli is not installed, only gzip is measured")
+
+    for name, data in payloads.items():
+        print(f"{name}: {len(data):,} bytes uncompressed")
+        for encoding, level, quality in settings:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                compressed = compress_bytes(data, encoding, level=level or 6, quality=quality or 4)
+            ms = (time.perf_counter() - started) / repeat * 1000
+            label = f"{encoding} {'level' if level else 'quality'} {level or quality}"
+            print(f"{label:>20}: {len(compressed):10,} bytes ({len(compressed) / len(data):6.1%}), "
+                  f"saves {len(data) - len(compressed):10,} bytes in {ms:8.2f} ms "
+                  f"({(len(data) - len(compressed)) / 1024 / max(ms, 0.001):,.0f} KiB saved per ms)")
+
+
+@bench.command("json")
+@click.option("--products", "count", default=10000, show_default=True)
+@click.option("--repeat", default=10, show_default=True, help="Serializations per provider")
+def json_providers(count, repeat):
+    """Serialization of Products.serialize() dicts with Flask's provider, the stdlib fallback and orjson"""
+    app = current_app._get_current_object()
+    products = [Products(**row).serialize() for row in synthetic_products(count)]
+    fallback = FastJSONProvider(app)
+    fallback.use_orjson = False
+    providers = {"flask default (stdlib)": DefaultJSONProvider(app), "fast, stdlib fallback": fallback}
+    if orjson is not None:
+        providers["fast, orjson"] = FastJSONProvider(app)
+    else:
+        print("orjson is not installed, only the stdlib providers are measured")
+
+    baseline = None
+    with app.test_request_context():
+        for name, provider in providers.items():
+            started = time.perf_counter()
+            for _ in range(repeat):
+                body = provider.response(products).get_data()
+            ms = (time.perf_counter() - started) / repeat * 1000
+            baseline = baseline or ms
+            print(f"{name:>24}: {ms:8.2f} ms per response of {count} products ({len(body):,} bytes), "
+                  f"{baseline / ms:5.1f}x")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, timeout=60.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            connection.request("GET", "/api/products")
+            connection.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def http_load(port, paths, concurrency, duration, headers=None):
+    """Keep-alive HTTP clients looping over `paths` for `duration` seconds, returns a summary"""
+    latencies, statuses = [], Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+    deadline = []
+
+    def worker(index):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        own_latencies, own_statuses = [], Counter()
+        barrier.wait()
+        request_index = index
+        while time.perf_counter() < deadline[0]:
+            path = paths[request_index % len(paths)]
+            request_index += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                own_statuses[response.status] += 1
+            except (OSError, http.client.HTTPException):
+                own_statuses["error"] += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            own_latencies.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            statuses.update(own_statuses)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    deadline.append(time.perf_counter() + duration)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, duration)
+
+
+@bench.command("server")
+@click.option("--profiles", default="sync,gthread,gevent", show_default=True, help="GUNICORN_PROFILE values to compare")
+@click.option("--concurrency", default=32, show_default=True, help="Concurrent keep-alive clients")
+@click.option("--duration", default=10.0, show_default=True, help="Seconds per profile")
+@click.option("--path", "paths", multiple=True, help="Paths requested in turn (default: catalog, search, users)")
+@click.option("--workers", default=None, type=int, help="WEB_CONCURRENCY for every profile")
+def server(profiles, concurrency, duration, paths, workers):
+    """Throughput and latency of gunicorn.conf.py under each worker profile, over real HTTP"""
+    app = current_app._get_current_object()
+    config = os.path.abspath(os.path.join(app.root_path, "..", "gunicorn.conf.py"))
+    paths = list(paths) or ["/api/products", "/api/products?sort=price&limit=48", "/api/products/search?q=cafe", "/api/users"]
+    bench_product("bench-server-cafe")
+
+    for profile in profiles.split(","):
+        if profile == "gevent" and importlib.util.find_spec("gevent") is None:
+            print(f"{profile:>24}: skipped, gevent is not installed")
+            continue
+        port = free_port()
+        env = dict(os.environ, GUNICORN_PROFILE=profile)
+        if workers:
+            env["WEB_CONCURRENCY"] = str(workers)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", app.root_path, "-c", config,
+             "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_for_server(port):
+                print(f"{profile:>24}: did not start")
+                continue
+            print_summary(profile, http_load(port, paths, concurrency, duration))
+        finally:
+            process.terminate()
+            process.wait(timeout=60)
+
+
+# imported on first use (api.stripe_client, api.admin), never while the app starts
+LAZY_MODULES = ("stripe", "flask_admin", "flask_swagger", "api.benchmarks", "api.fake_stripe")
+
+
+def parse_importtime(output):
+    """[(module, self_us, cumulative_us, depth)] from the stderr of python -X importtime"""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        # the header line has no numbers
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return modules
+
+
+def measure_startup(cwd, module="app"):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise click.ClickException(f"import {module} failed:\n{result.stderr[-2000:]}")
+    return wall, parse_importtime(result.stderr)
+
+
+@bench.command("startup")
+@click.option("--repeat", default=5, show_default=True, help="Fresh interpreters, the fastest one is reported")
+@click.option("--top", default=15, show_default=True, help="Slowest modules listed")
+@click.option("--budget-ms", default=1000.0, show_default=True, help="Fail when importing the app takes longer")
+def startup(repeat, top, budget_ms):
+    """Cold start of the app: python -X importtime -c 'import app' in a fresh interpreter"""
+    app = current_app._get_current_object()
+    # the first run also writes the .pyc files, it is not counted
+    measure_startup(app.root_path)
+    runs = [measure_startup(app.root_path) for _ in range(repeat)]
+    wall, modules = min(runs, key=lambda run: run[0])
+
+    total_ms = next((cumulative for name, _, cumulative, depth in modules if name == "app" and depth == 0), 0) / 1000
+    print(f"import app: {total_ms:,.1f} ms, process wall time {wall * 1000:,.1f} ms "
+          f"(best of {repeat}, {len(modules)} modules)")
+
+    # the direct imports of app and the modules that cost the most by themselves
+    print(f"\n{'cumulative ms':>14} {'self ms':>9}  module")
+    direct = sorted((m for m in modules if m[3] == 1), key=lambda m: m[2], reverse=True)
+    for name, self_us, cumulative, _ in direct[:top]:
+        print(f"{cumulative / 1000:>14,.1f} {self_us / 1000:>9,.1f}  {name}")
+    print(f"\n{'self ms':>14}  module")
+    for name, self_us, _, _ in sorted(modules, key=lambda m: m[1], reverse=True)[:top]:
+        print(f"{self_us / 1000:>14,.1f}  {name}")
+
+    loaded = sorted({name for name, _, _, _ in modules
+                     if any(name == lazy or name.startswith(lazy + ".") for lazy in LAZY_MODULES)})
+    failed = False
+    if loaded:
+        print(f"\nimported at startup, should load on first use: {', '.join(loaded)}")
+        failed = True
+    if total_ms > budget_ms:
+        print(f"\nover budget: {total_ms:,.1f} ms > {budget_ms:,.1f} ms")
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+def run_endpoint(threads, duration, send):
+    """
+    `threads` clients calling send(client, thread_index, iteration) for
+    `duration` seconds; send returns the response, or None when that thread
+    has nothing left to send. Also counts the SQL statements of every request.
+    """
+    app = current_app._get_current_object()
+    latencies, statuses, queries = [], Counter(), []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+    deadline = []
+
+    def worker(index):
+        client = app.test_client()
+        own_latencies, own_statuses, own_queries = [], Counter(), []
+        barrier.wait()
+        iteration = 0
+        while time.perf_counter() < deadline[0]:
+            started = time.perf_counter()
+            with count_queries() as stats:
+                response = send(client, index, iteration)
+                if response is None:
+                    break
+                # streamed bodies are produced while they are read
+                response.get_data()
+                response.close()
+            own_latencies.append(time.perf_counter() - started)
+            own_statuses[response.status_code] += 1
+            own_queries.append(stats.count)
+            iteration += 1
+        with lock:
+            latencies.extend(own_latencies)
+            statuses.update(own_statuses)
+            queries.extend(own_queries)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = time.perf_counter()
+    deadline.append(started + duration)
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    summary = summarize(latencies, statuses, time.perf_counter() - started)
+    summary["sql_per_request"] = round(sum(queries) / len(queries), 2) if queries else None
+    summary["sql_max"] = max(queries, default=None)
+    return summary
+
+
+def bench_products(prefix, count, stock):
+    # the missing ones in one INSERT, every run starts with the same stock
+    existing = set(db.session.scalars(select(Products.name).where(Products.name.like(f"{prefix}-%"))))
+    missing = [f"{prefix}-{index}" for index in range(count) if f"{prefix}-{index}" not in existing]
+    if missing:
+        db.session.execute(insert(Products), [
+            {"name": name, "description": f"{name} cafe tostado", "img": "", "brand": "bench", "type": "bench",
+             "price": 10.0 + index % 20, "stock": stock}
+            for index, name in enumerate(missing)
+        ])
+    db.session.execute(update(Products).where(Products.name.like(f"{prefix}-%")).values(stock=stock))
+    db.session.commit()
+    return list(db.session.scalars(
+        select(Products.id).where(Products.name.like(f"{prefix}-%")).order_by(Products.id).limit(count)
+    ))
+
+
+def stripe_signature(payload, secret, timestamp=None):
+    # the Stripe-Signature header of a webhook delivery
+    timestamp = timestamp or int(time.time())
+    signed = hmac.new(secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), hashlib.sha256)
+    return f"t={timestamp},v1={signed.hexdigest()}"
+
+
+def endpoint_scenarios(users, products, password, webhook_secret, run_id):
+    """
+    [(name, send)] in the order they run: reads first, while the catalog
+    cache is warm, then the writes. users: [(id, email, token)], one per thread.
+    """
+    state = [{"cart": [], "favorites": [], "registered": [], "created": [], "job": None} for _ in users]
+
+    def auth(index, token=None):
+        return {"Authorization": f"Bearer {token or users[index][2]}"}
+
+    def product(index, iteration):
+        # every thread walks the catalog from its own offset
+        return products[(index * 7 + iteration) % len(products)]
+
+    def cart_add(client, index, iteration):
+        product_id = product(index, iteration)
+        state[index]["cart"].append(product_id)
+        return client.post("/api/shopping-cart", json={"product_id": product_id, "quantity": 1}, headers=auth(index))
+
+    def cart_patch(client, index, iteration):
+        cart = state[index]["cart"] or [products[0]]
+        operations = [{"op": "increment", "product_id": cart[iteration % len(cart)], "quantity": 1},
+                      {"op": "set", "product_id": cart[(iteration + 1) % len(cart)], "quantity": 2}]
+        return client.patch("/api/shopping-cart", json={"operations": operations}, headers=auth(index))
+
+    def cart_put(client, index, iteration):
+        cart = state[index]["cart"] or [products[0]]
+        return client.put(f"/api/shopping-cart/{cart[iteration % len(cart)]}", json={"quantity": 1 + iteration % 3},
+                          headers=auth(index))
+
+    def cart_delete(client, index, iteration):
+        cart = sorted(set(state[index]["cart"]))
+        if iteration >= len(cart):
+            return None
+        return client.delete(f"/api/shopping-cart/{cart[iteration]}", headers=auth(index))
+
+    def favorite_toggle(client, index, iteration):
+        product_id = product(index, iteration)
+        state[index]["favorites"].append(product_id)
+        return client.post("/api/favorites", json={"product_id": product_id}, headers=auth(index))
+
+    def favorite_delete(client, index, iteration):
+        # a product toggled an odd number of times is still a favorite
+        toggles = Counter(state[index]["favorites"])
+        favorites = sorted(product_id for product_id, count in toggles.items() if count % 2)
+        if iteration >= len(favorites):
+            return None
+        return client.delete(f"/api/favorites/{favorites[iteration]}", headers=auth(index))
+
+    def checkout_session(client, index, iteration):
+        response = client.post("/api/create-checkout-session", headers=auth(index))
+        if response.status_code in (200, 202):
+            state[index]["job"] = response.get_json()["job_id"]
+        return response
+
+    def checkout_poll(client, index, iteration):
+        job = state[index]["job"]
+        if job is None:
+            return None
+        return client.get(f"/api/create-checkout-session/{job}", headers=auth(index))
+
+    def webhook(client, index, iteration):
+        # an event type the app does not handle: the intake path only, no order
+        payload = json.dumps({"id": f"evt_bench_{run_id}_{index}_{iteration}", "object": "event",
+                              "type": "customer.created", "data": {"object": {}}})
+        return client.post("/api/stripe/webhook", data=payload, content_type="application/json",
+                           headers={"Stripe-Signature": stripe_signature(payload, webhook_secret)})
+
+    def register(client, index, iteration):
+        name = f"bench-endpoints-reg-{run_id}-{index}-{iteration}"
+        response = client.post("/api/register", json={
+            "email": f"{name}@bench.local", "user_name": name, "password": password,
+            "first_name": "Bench", "last_name": name, "phone": name, "address": name,
+        })
+        if response.status_code == 201:
+            body = response.get_json()
+            state[index]["registered"].append((body["user"]["user_id"], body["token"]))
+        return response
+
+    def user_delete(client, index, iteration):
+        registered = state[index]["registered"]
+        if iteration >= len(registered):
+            return None
+        user_id, token = registered[iteration]
+        return client.delete(f"/api/user/{user_id}", headers=auth(index, token))
+
+    def product_create(client, index, iteration):
+        response = client.post("/api/products", json={
+            "name": f"bench-endpoints-new-{run_id}-{index}-{iteration}", "description": "bench", "img": "",
+            "brand": "bench", "type": "bench", "price": 12.5, "stock": 10,
+        }, headers=auth(index))
+        if response.status_code == 200:
+            state[index]["created"].append(response.get_json()["product"]["id"])
+        return response
+
+    def product_update(client, index, iteration):
+        created = state[index]["created"]
+        if not created:
+            return None
+        return client.put(f"/api/products/{created[iteration % len(created)]}",
+                          json={"price": 12.5 + iteration % 5, "stock": 10}, headers=auth(index))
+
+    def product_delete(client, index, iteration):
+        created = state[index]["created"]
+        if iteration >= len(created):
+            return None
+        return client.delete(f"/api/products/{created[iteration]}", headers=auth(index))
+
+    return [
+        ("GET /api/hello", lambda client, index, iteration: client.get("/api/hello")),
+        ("GET /api/cache/stats", lambda client, index, iteration: client.get("/api/cache/stats")),
+        ("GET /api/products", lambda client, index, iteration: client.get("/api/products")),
+        ("GET /api/products?sort=price", lambda client, index, iteration: client.get("/api/products?sort=price&limit=48")),
+        ("GET /api/products/search", lambda client, index, iteration: client.get("/api/products/search?q=cafe")),
+        ("GET /api/products/<id>", lambda client, index, iteration: client.get(f"/api/products/{product(index, iteration)}")),
+        ("GET /api/users", lambda client, index, iteration: client.get("/api/users")),
+        ("GET /api/users/<id>", lambda client, index, iteration: client.get(f"/api/users/{users[index][0]}")),
+        ("GET /api/user", lambda client, index, iteration: client.get("/api/user", headers=auth(index))),
+        ("POST /api/login", lambda client, index, iteration: client.post(
+            "/api/login", json={"email": users[index][1], "password": password})),
+        ("PUT /api/user/<id>", lambda client, index, iteration: client.put(
+            f"/api/user/{users[index][0]}", json={"address": f"bench street {iteration}"}, headers=auth(index))),
+        ("POST /api/shopping-cart", cart_add),
+        ("GET /api/shopping-cart", lambda client, index, iteration: client.get("/api/shopping-cart", headers=auth(index))),
+        ("PATCH /api/shopping-cart", cart_patch),
+        ("PUT /api/shopping-cart/<id>", cart_put),
+        ("POST /api/favorites", favorite_toggle),
+        ("GET /api/favorites", lambda client, index, iteration: client.get("/api/favorites", headers=auth(index))),
+        ("DELETE /api/favorites/<id>", favorite_delete),
+        ("POST /api/checkout", lambda client, index, iteration: client.post(
+            "/api/checkout", json={"product_id": product(index, iteration)}, headers=auth(index))),
+        ("POST /api/create-checkout-session", checkout_session),
+        ("GET /api/create-checkout-session/<id>", checkout_poll),
+        ("POST /api/stripe/webhook", webhook),
+        ("DELETE /api/shopping-cart/<id>", cart_delete),
+        ("POST /api/products", product_create),
+        ("PUT /api/products/<id>", product_update),
+        ("DELETE /api/products/<id>", product_delete),
+        ("POST /api/register", register),
+        ("DELETE /api/user/<id>", user_delete),
+    ]
+
+
+def git_revision(path):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_endpoint(name, summary):
+    print(f"{name:>38}: {summary['requests']:6d} req {summary['throughput_rps']:8.1f} req/s  "
+          f"p50 {summary['p50_ms']} ms  p95 {summary['p95_ms']} ms  p99 {summary['p99_ms']} ms  "
+          f"sql {summary['sql_per_request']}/req  statuses {summary['statuses']}")
+
+
+def hot_queries():
+    # the lookups behind the cart, favorites, checkout and order routes, on ids that exist
+    user_id = (db.session.scalar(select(Favorites.user_id).limit(1))
+               or db.session.scalar(select(User.id).limit(1)) or 1)
+    product_id = db.session.scalar(select(Favorites.product_id).filter_by(user_id=user_id).limit(1)) or 1
+    order_id = db.session.scalar(select(ProductsInOrder.order_id).limit(1)) or 1
+    return {
+        "cart line (user, product)": select(ShoppingCart).filter_by(user_id=user_id, product_id=product_id),
+        "cart of a user": select(ShoppingCart).filter_by(user_id=user_id),
+        "favorite (user, product)": select(Favorites).filter_by(user_id=user_id, product_id=product_id),
+        "favorites of a user": select(Products.id, Products.name).join(Favorites, Favorites.product_id == Products.id)
+                                .where(Favorites.user_id == user_id),
+        "checkouts of a user": select(Checkout).filter_by(user_id=user_id),
+        "checkout of an order": select(Checkout).filter_by(order_id=order_id),
+        "lines of an order": select(ProductsInOrder).filter_by(order_id=order_id),
+        "orders of a product": select(ProductsInOrder).filter_by(product_id=product_id),
+        "products of a user": select(Products.id).filter_by(user_id=user_id),
+    }
+
+
+def explain(statement, analyze=False):
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    connection = db.session.connection()
+    if dialect.name == "sqlite":
+        return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+    if dialect.name == "postgresql":
+        options = "(ANALYZE, BUFFERS) " if analyze else ""
+        return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {options}{sql}")]
+    return []
+
+
+def query_plans(analyze=False):
+    plans = {name: explain(statement, analyze) for name, statement in hot_queries().items()}
+    db.session.rollback()
+    return plans
+
+
+def print_plans(plans):
+    for name, lines in plans.items():
+        print(f"{name}:")
+        for line in lines:
+            print(f"    {line}")
+
+
+def print_plan_changes(before, after):
+    changed = [name for name, lines in after.items() if before.get(name) not in (None, lines)]
+    for name in changed:
+        print(f"\nplan of {name} changed:")
+        print("\n".join(f"  - {line}" for line in before[name]))
+        print("\n".join(f"  + {line}" for line in after[name]))
+    return changed
+
+
+def print_comparison(baseline, results, plans=None):
+    print(f"\nagainst {baseline['meta'].get('revision')} ({baseline['meta'].get('created_at')}):")
+    for name, summary in results.items():
+        before = baseline["endpoints"].get(name)
+        if not before or not before.get("p95_ms") or not summary.get("p95_ms"):
+            continue
+        change = (summary["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+        print(f"{name:>38}: p95 {before['p95_ms']} -> {summary['p95_ms']} ms ({change:+.0f}%)  "
+              f"sql {before['sql_per_request']} -> {summary['sql_per_request']}/req")
+    print_plan_changes(baseline.get("plans", {}), plans or {})
+
+
+@bench.command("endpoints")
+@click.option("--concurrency", default=8, show_default=True, help="Clients per endpoint, each with its own user")
+@click.option("--duration", default=3.0, show_default=True, help="Seconds per endpoint")
+@click.option("--products", "product_count", default=200, show_default=True, help="Bench products in the catalog")
+@click.option("--only", multiple=True, help="Only the endpoints whose name contains this text")
+@click.option("--output", default="bench-endpoints.json", show_default=True, help="JSON results, '' to skip")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Previous --output to compare with")
+@click.option("--create-tables", is_flag=True, help="db.create_all() first, for a new SQLite database")
+def endpoints(concurrency, duration, product_count, only, output, baseline, create_tables):
+    """Every route of the api blueprint under load, Stripe answered by a local fake"""
+    app = current_app._get_current_object()
+    if create_tables:
+        db.create_all()
+
+    password = "bench-password"
+    password_hash = hash_password(password)
+    users = []
+    for index in range(concurrency):
+        user_id = bench_user(f"bench-endpoints-{index}", password_hash)
+        users.append((user_id, db.session.get(User, user_id).email, create_access_token(identity=str(user_id))))
+    user_ids = [user_id for user_id, _, _ in users]
+    products = bench_products("bench-endpoints-product", product_count, stock=1_000_000)
+
+    # every run starts from empty carts and favorites
+    release_holds(StockHold.user_id.in_(user_ids))
+    db.session.execute(delete(ShoppingCart).where(ShoppingCart.user_id.in_(user_ids)))
+    db.session.execute(delete(Favorites).where(Favorites.user_id.in_(user_ids)))
+    db.session.commit()
+    db.session.remove()
+
+    stripe = start_fake_stripe()
+    saved_env = {name: os.environ.get(name) for name in ("STRIPE_API_BASE", "STRIPE_SECRET_KEY")}
+    saved_secret = app.config.get("STRIPE_WEBHOOK_SECRET")
+    os.environ.update(STRIPE_API_BASE=stripe.url, STRIPE_SECRET_KEY="sk_test_bench")
+    configure_stripe(app)
+    webhook_secret = app.config["STRIPE_WEBHOOK_SECRET"] = "whsec_bench"
+
+    run_id = int(time.time())
+    results = {}
+    try:
+        for name, send in endpoint_scenarios(users, products, password, webhook_secret, run_id):
+            if only and not any(text in name for text in only):
+                continue
+            results[name] = run_endpoint(concurrency, duration, send)
+            print_endpoint(name, results[name])
+    finally:
+        # checkouts and price syncs still talking to the fake
+        if not background.wait_idle(timeout=60):
+            print("background jobs still running after 60s")
+        stripe.shutdown()
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        configure_stripe(app)
+        app.config["STRIPE_WEBHOOK_SECRET"] = saved_secret
+
+        # what the run left behind: stock holds, test events, products and users it created
+        db.session.remove()
+        release_holds(StockHold.user_id.in_(user_ids))
+        db.session.execute(delete(StripeEvent).where(StripeEvent.id.like(f"evt_bench_{run_id}_%")))
+        # the ones the delete endpoints did not get to in time
+        db.session.execute(delete(Products).where(Products.name.like(f"bench-endpoints-new-{run_id}-%")))
+        db.session.execute(delete(User).where(User.user_name.like(f"bench-endpoints-reg-{run_id}-%")))
+        db.session.commit()
+
+    document = {
+        "meta": {
+            "revision": git_revision(app.root_path),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "database": db.engine.dialect.name,
+            "python": platform.python_version(),
+            "concurrency": concurrency,
+            "duration": duration,
+            "products": len(products),
+        },
+        "endpoints": results,
+        "plans": query_plans(),
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print(f"\nresults written to {output}")
+    if baseline:
+        with open(baseline) as f:
+            print_comparison(json.load(f), results, document["plans"])
+
+
+@bench.command("plans")
+@click.option("--analyze", is_flag=True, help="EXPLAIN (ANALYZE, BUFFERS) on Postgres, runs the queries")
+@click.option("--output", default="", help="Also write the plans as JSON")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Previous --output to compare with")
+def plans(analyze, output, baseline):
+    """Query plans of the hot lookups; run it before and after `flask db upgrade`"""
+    document = {"meta": {"revision": git_revision(current_app.root_path), "database": db.engine.dialect.name},
+                "plans": query_plans(analyze)}
+    print_plans(document["plans"])
+    if output:
+        with open(output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print(f"\nplans written to {output}")
+    if baseline:
+        with open(baseline) as f:
+            before = json.load(f).get("plans", {})
+        changed = print_plan_changes(before, document["plans"])
+        print(f"\n{len(changed)} of {len(document['plans'])} plans changed")
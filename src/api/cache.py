@@ -0,0 +1,348 @@
+"""
+In-process LRU + TTL caches whose invalidations reach every gunicorn worker.
+
+Each cache listens on a broadcast channel. Invalidating a channel (or a single
+key of it) clears it locally and appends the invalidation to the channel log in
+the shared backend, which bumps the channel generation; the other workers
+compare that generation at most every CACHE_POLL_INTERVAL seconds and, when it
+moved, read the invalidations they missed and drop those keys, or everything.
+
+The backend is chosen with CACHE_BROADCAST_URL:
+    local://            single process only (tests, flask shell)
+    file:///some/dir    one file per channel, shared by the workers of a host (default)
+    redis://host:6379/0 shared by every instance, needs the redis package
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from api.models import db
+
+try:
+    import fcntl
+except ImportError:
+    # windows, a dev server has a single publisher anyway
+    fcntl = None
+
+_MISSING = object()
+
+CACHES = {}
+
+# callables (cache_name, hit) run on every lookup, e.g. the metrics counters
+LOOKUP_LISTENERS = []
+
+
+# the whole channel, any other token is a json encoded key
+ALL_KEYS = "*"
+# invalidations a backend remembers, a worker that missed more clears everything
+BROADCAST_LOG_SIZE = 1000
+# bytes of a file backend log before it is started over
+BROADCAST_FILE_SIZE = 1 << 20
+
+
+def encode_key(key):
+    return ALL_KEYS if key is None else json.dumps(key)
+
+
+def decode_key(token):
+    # json turns the tuple keys into lists
+    def as_key(value):
+        return tuple(as_key(item) for item in value) if isinstance(value, list) else value
+    return as_key(json.loads(token))
+
+
+class LocalBroadcast:
+    def __init__(self):
+        self._logs = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, token=ALL_KEYS):
+        with self._lock:
+            generation, log = self._logs.get(channel, (0, deque(maxlen=BROADCAST_LOG_SIZE)))
+            log.append(token)
+            self._logs[channel] = (generation + 1, log)
+
+    def generation(self, channel):
+        return self._logs.get(channel, (0, ()))[0]
+
+    def changes(self, channel, since):
+        """(generation, tokens published after `since`), tokens is None when they are no longer known"""
+        with self._lock:
+            generation, log = self._logs.get(channel, (0, ()))
+            missed = generation - since
+            if missed < 0 or missed > len(log):
+                return generation, None
+            return generation, list(log)[len(log) - missed:]
+
+
+class FileBroadcast:
+    # one line per invalidation after an "epoch <id>" header line. The generation is
+    # (epoch, size of the file): a reader that saw the same epoch reads the missed lines
+    # from its previous size on. Past BROADCAST_FILE_SIZE a publisher replaces the file
+    # with an empty one of a new epoch, so it does not grow for the life of the host; the
+    # readers of the old epoch clear everything once. Publishers hold an flock on
+    # <channel>.lock, so nobody appends to a file that was just replaced
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, channel, suffix=".log"):
+        return os.path.join(self.directory, channel + suffix)
+
+    def _new_log(self, path, lines=()):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write("".join(f"{line}\n" for line in (f"epoch {uuid.uuid4().hex}", *lines)).encode("utf-8"))
+        os.replace(tmp, path)
+
+    def publish(self, channel, token=ALL_KEYS):
+        path = self._path(channel)
+        with open(self._path(channel, ".lock"), "ab") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                self._new_log(path)
+            with open(path, "ab") as f:
+                f.write(token.encode("utf-8") + b"\n")
+                size = f.tell()
+            if size > BROADCAST_FILE_SIZE:
+                # a reader that only knew the previous epoch, or none, cannot tell what it missed
+                self._new_log(path, [ALL_KEYS])
+
+    def _read(self, channel, since=None):
+        # (epoch, size, lines after `since`), lines is None when they are no longer known
+        try:
+            with open(self._path(channel), "rb") as f:
+                epoch = f.readline().decode("utf-8").strip()
+                size = os.fstat(f.fileno()).st_size
+                if since is None:
+                    return epoch, size, None
+                if since == 0:
+                    # there was no file, every line of this one is new
+                    offset = f.tell()
+                elif epoch != since[0] or size < since[1]:
+                    # the file was replaced or truncated since
+                    return epoch, size, None
+                else:
+                    offset = since[1]
+                f.seek(offset)
+                data = f.read(size - offset)
+        except FileNotFoundError:
+            return None, 0, None
+        # whole lines only, a line being written is read on the next poll
+        complete = data[:data.rfind(b"\n") + 1]
+        return epoch, offset + len(complete), complete.decode("utf-8").splitlines()
+
+    def generation(self, channel):
+        epoch, size, _ = self._read(channel)
+        return (epoch, size) if epoch is not None else 0
+
+    def changes(self, channel, since):
+        epoch, size, lines = self._read(channel, since)
+        return ((epoch, size) if epoch is not None else 0), lines
+
+
+class RedisBroadcast:
+    # works with any redis-py compatible client, e.g. fakeredis.FakeRedis() in tests
+    def __init__(self, client, prefix="cache-broadcast:"):
+        self.client = client
+        self.prefix = prefix
+
+    def publish(self, channel, token=ALL_KEYS):
+        log = self.prefix + channel + ":log"
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(log, token)
+        pipe.ltrim(log, -BROADCAST_LOG_SIZE, -1)
+        pipe.incr(self.prefix + channel)
+        pipe.execute()
+
+    def generation(self, channel):
+        return int(self.client.get(self.prefix + channel) or 0)
+
+    def changes(self, channel, since):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.prefix + channel)
+        pipe.lrange(self.prefix + channel + ":log", -BROADCAST_LOG_SIZE, -1)
+        generation, log = pipe.execute()
+        generation = int(generation or 0)
+        missed = generation - since
+        if missed < 0 or missed > len(log):
+            return generation, None
+        return generation, [token.decode("utf-8") if isinstance(token, bytes) else token
+                            for token in log[len(log) - missed:]]
+
+
+def broadcast_from_url(url):
+    if not url:
+        return FileBroadcast(os.path.join(tempfile.gettempdir(), "api-cache-broadcast"))
+
+    parsed = urlparse(url)
+    if parsed.scheme == "local":
+        return LocalBroadcast()
+    if parsed.scheme == "file":
+        return FileBroadcast(parsed.path)
+    if parsed.scheme in ("redis", "rediss"):
+        import redis
+        return RedisBroadcast(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported CACHE_BROADCAST_URL: {url}")
+
+
+class LRUTTLCache:
+    # maxsize/ttl left as None take CACHE_MAXSIZE/CACHE_TTL in setup_cache
+    def __init__(self, name, channel, maxsize=None, ttl=None):
+        self.name = name
+        self.channel = channel
+        self.default_maxsize = maxsize
+        self.default_ttl = ttl
+        self.maxsize = maxsize or 1024
+        self.ttl = ttl or 60.0
+        self.broadcast = LocalBroadcast()
+        self.poll_interval = 1.0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every clear, a load that started before a clear is not stored
+        self._local_generation = 0
+        self._remote_generation = None
+        self._next_poll = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        CACHES[name] = self
+
+    def _clear_locked(self):
+        self._data.clear()
+        self._local_generation += 1
+
+    def _sync(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.poll_interval
+        remote = self.broadcast.generation(self.channel)
+        if self._remote_generation is None or remote == self._remote_generation:
+            self._remote_generation = remote
+            return
+        remote, tokens = self.broadcast.changes(self.channel, self._remote_generation)
+        with self._lock:
+            if tokens is None or ALL_KEYS in tokens:
+                self._clear_locked()
+            else:
+                for token in tokens:
+                    self._data.pop(decode_key(token), None)
+                self._local_generation += 1
+            self._remote_generation = remote
+
+    def get(self, key, default=None):
+        self._sync()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            hit = entry is not _MISSING and entry[0] > time.monotonic()
+            if hit:
+                self._data.move_to_end(key)
+                self.hits += 1
+            else:
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+        for listener in LOOKUP_LISTENERS:
+            listener(self.name, hit)
+        return entry[1] if hit else default
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._local_generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self._local_generation
+        value = loader()
+        if value is not None:
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._clear_locked()
+            else:
+                self._data.pop(key, None)
+                # a load of the key that started before is not stored
+                self._local_generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def invalidate_channel(channel, key=None):
+    """Drops `key` (everything when None) from the caches of the channel in every worker"""
+    # our own publish is seen again on the next poll, which only costs one extra clear
+    caches = [cache for cache in CACHES.values() if cache.channel == channel]
+    for cache in caches:
+        cache.invalidate(key)
+    if caches:
+        caches[0].broadcast.publish(channel, encode_key(key))
+
+
+def invalidate_on_commit(channel, key=None):
+    # the invalidation waits for the commit, otherwise a concurrent read could
+    # cache the old rows again before the write is visible
+    db.session.info.setdefault('invalidate_channels', set()).add((channel, key))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    for channel, key in session.info.pop('invalidate_channels', ()):
+        invalidate_channel(channel, key)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop('invalidate_channels', None)
+
+
+def setup_cache(app):
+    app.config.setdefault('CACHE_BROADCAST_URL', os.getenv('CACHE_BROADCAST_URL'))
+    app.config.setdefault('CACHE_POLL_INTERVAL', float(os.getenv('CACHE_POLL_INTERVAL', 1.0)))
+    app.config.setdefault('CACHE_MAXSIZE', int(os.getenv('CACHE_MAXSIZE', 1024)))
+    app.config.setdefault('CACHE_TTL', float(os.getenv('CACHE_TTL', 60)))
+
+    broadcast = broadcast_from_url(app.config['CACHE_BROADCAST_URL'])
+    for cache in CACHES.values():
+        cache.broadcast = broadcast
+        cache.poll_interval = app.config['CACHE_POLL_INTERVAL']
+        cache.maxsize = cache.default_maxsize or app.config['CACHE_MAXSIZE']
+        cache.ttl = cache.default_ttl or app.config['CACHE_TTL']
+    app.extensions['cache_broadcast'] = broadcast
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
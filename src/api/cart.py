@@ -0,0 +1,117 @@
+"""
+Shopping cart writes as single SQL statements, so concurrent requests of the
+same user (double clicks, two tabs) never lose an update.
+"""
+from sqlalchemy import select, delete
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects import postgresql, sqlite
+from api.models import db, ShoppingCart
+from api.utils import APIException
+
+CART_OPERATIONS = ('set', 'increment', 'remove')
+MAX_CART_OPERATIONS = 200
+
+
+def dialect_insert(table):
+    # both dialects share the INSERT ... ON CONFLICT syntax
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise RuntimeError(f"Cart upserts are not supported on {dialect}")
+
+
+def add_to_cart(user_id, product_id, quantity):
+    # INSERT ... ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + :n
+    table = ShoppingCart.__table__
+    stmt = dialect_insert(table).values(user_id=user_id, product_id=product_id, quantity=quantity)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.product_id],
+        set_={'quantity': table.c.quantity + stmt.excluded.quantity},
+    ).returning(table.c.quantity)
+    return db.session.execute(stmt).scalar_one()
+
+
+def _upsert(table, increment):
+    stmt = dialect_insert(table)
+    quantity = table.c.quantity + stmt.excluded.quantity if increment else stmt.excluded.quantity
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.product_id],
+        set_={'quantity': quantity},
+    )
+
+
+def parse_cart_operations(payload):
+    operations = payload.get('operations') if isinstance(payload, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise APIException("'operations' must be a non empty list")
+    if len(operations) > MAX_CART_OPERATIONS:
+        raise APIException(f"At most {MAX_CART_OPERATIONS} operations per request")
+
+    parsed = []
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in CART_OPERATIONS:
+            raise APIException(f"Operation {index}: 'op' must be one of {', '.join(CART_OPERATIONS)}")
+        product_id = operation.get('product_id')
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            raise APIException(f"Operation {index}: integer 'product_id' is required")
+        quantity = operation.get('quantity')
+        if isinstance(quantity, bool):
+            quantity = None
+        if op == 'set' and (not isinstance(quantity, int) or quantity < 0):
+            raise APIException(f"Operation {index}: 'set' needs an integer quantity >= 0")
+        if op == 'increment' and (not isinstance(quantity, int) or quantity == 0):
+            raise APIException(f"Operation {index}: 'increment' needs a non zero integer quantity")
+        parsed.append((op, product_id, quantity))
+    return parsed
+
+
+def fold_cart_operations(operations):
+    # the operations are applied in order, folded into one final action per product:
+    # ('remove', None), ('set', n) or ('increment', n). A line that ends at zero or below is removed
+    actions = {}
+    for op, product_id, quantity in operations:
+        current = actions.get(product_id)
+        if op == 'remove':
+            action = ('remove', None)
+        elif op == 'set':
+            action = ('set', quantity)
+        elif current is None:
+            action = ('increment', quantity)
+        elif current[0] == 'remove':
+            action = ('set', quantity)
+        else:
+            action = (current[0], current[1] + quantity)
+        if action[0] == 'set' and action[1] <= 0:
+            action = ('remove', None)
+        actions[product_id] = action
+    return actions
+
+
+def apply_cart_operations(user_id, operations):
+    # one bulk statement per kind of action, the caller commits them as one transaction
+    table = ShoppingCart.__table__
+    actions = fold_cart_operations(operations)
+
+    removed = [product_id for product_id, (action, _) in actions.items() if action == 'remove']
+    sets = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}
+            for product_id, (action, quantity) in actions.items() if action == 'set']
+    increments = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}
+                  for product_id, (action, quantity) in actions.items() if action == 'increment']
+
+    if removed:
+        db.session.execute(delete(table).where(table.c.user_id == user_id, table.c.product_id.in_(removed)))
+    if sets:
+        db.session.execute(_upsert(table, increment=False), sets)
+    if increments:
+        db.session.execute(_upsert(table, increment=True), increments)
+    # negative increments can leave lines (new or existing) at zero or below, they never reach a checkout
+    db.session.execute(delete(table).where(table.c.user_id == user_id, table.c.quantity <= 0))
+
+
+def cart_items(user_id):
+    return db.session.scalars(
+        select(ShoppingCart).filter_by(user_id=user_id).options(joinedload(ShoppingCart.product))
+    ).all()
@@ -0,0 +1,197 @@
+"""
+Catalog read helpers used by the product endpoints: filters, sort options,
+keyset (cursor) pagination over the products table and conditional GETs
+driven by the catalog version counter. Reads go through catalog_cache, which
+every catalog write invalidates on commit.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import request, make_response
+from sqlalchemy import select, update, tuple_
+from api.models import db, Products, CatalogVersion, utcnow
+from api.utils import APIException, encode_cursor, decode_cursor
+from api.cache import LRUTTLCache, invalidate_on_commit
+
+CATALOG_CHANNEL = 'catalog'
+
+# keys: ('version',), ('product', id) and ('list', filters)
+catalog_cache = LRUTTLCache('catalog', channel=CATALOG_CHANNEL)
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+STREAM_BATCH_SIZE = 500
+
+# sort option -> (columns that form the keyset, descending)
+# every option ends in "id" so the keyset is unique and the pages are stable
+PRODUCT_SORTS = {
+    'id': (('id',), False),
+    '-id': (('id',), True),
+    'price': (('price', 'id'), False),
+    '-price': (('price', 'id'), True),
+}
+
+
+def catalog_projection():
+    # stock changes with every checkout, it is left out of the cached and ETagged catalog
+    # so reserving and releasing it does not invalidate the catalog of every worker
+    return [column for column in Products.projection() if column.key != 'stock']
+
+
+def parse_product_filters(args):
+    sort = args.get('sort', 'id')
+    if sort not in PRODUCT_SORTS:
+        raise APIException(f"Invalid sort '{sort}', use one of: {', '.join(PRODUCT_SORTS)}")
+
+    limit = args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+
+    return {
+        'brand': args.get('brand') or None,
+        'type': args.get('type') or None,
+        'min_price': args.get('min_price', type=float),
+        'max_price': args.get('max_price', type=float),
+        'sort': sort,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'cursor': args.get('cursor') or None,
+    }
+
+
+def filter_products(stmt, filters):
+    if filters['brand'] is not None:
+        stmt = stmt.where(Products.brand == filters['brand'])
+    if filters['type'] is not None:
+        stmt = stmt.where(Products.type == filters['type'])
+    if filters['min_price'] is not None:
+        stmt = stmt.where(Products.price >= filters['min_price'])
+    if filters['max_price'] is not None:
+        stmt = stmt.where(Products.price <= filters['max_price'])
+    return stmt
+
+
+def order_products(stmt, filters):
+    keys, descending = PRODUCT_SORTS[filters['sort']]
+    columns = [getattr(Products, key) for key in keys]
+    return stmt.order_by(*[column.desc() if descending else column.asc() for column in columns])
+
+
+def list_products(filters):
+    key = ('list', tuple(sorted(filters.items())))
+    return catalog_cache.get_or_load(key, lambda: _load_product_page(filters))
+
+
+def after_cursor(stmt, filters):
+    if not filters['cursor']:
+        return stmt
+    keys, descending = PRODUCT_SORTS[filters['sort']]
+    columns = [getattr(Products, key) for key in keys]
+    values = decode_cursor(filters['cursor'], len(keys))
+    if len(columns) == 1:
+        keyset, bound = columns[0], values[0]
+    else:
+        keyset, bound = tuple_(*columns), tuple_(*values)
+    return stmt.where(keyset < bound if descending else keyset > bound)
+
+
+def _load_product_page(filters):
+    keys, descending = PRODUCT_SORTS[filters['sort']]
+    stmt = after_cursor(order_products(filter_products(select(*catalog_projection()), filters), filters), filters)
+
+    # one extra row tells us whether there is a next page
+    limit = filters['limit']
+    products = db.session.execute(stmt.limit(limit + 1)).mappings().all()
+
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(*[products[-1][key] for key in keys])
+
+    return {
+        'products': [dict(product) for product in products],
+        'next_cursor': next_cursor,
+    }
+
+
+def iter_products(filters):
+    # every matching product (limit is ignored), fetched from the database in batches.
+    # it is a generator so the query runs while the response streams, not in the view
+    stmt = after_cursor(order_products(filter_products(select(*catalog_projection()), filters), filters), filters)
+    for product in db.session.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE)).mappings():
+        yield dict(product)
+
+
+def get_product_data(product_id):
+    return catalog_cache.get_or_load(('product', product_id), lambda: _load_product(product_id))
+
+
+def _load_product(product_id):
+    product = db.session.execute(select(*catalog_projection()).where(Products.id == product_id)).mappings().first()
+    return dict(product) if product else None
+
+
+def get_catalog_version():
+    return catalog_cache.get_or_load(('version',), _load_catalog_version)
+
+
+def _load_catalog_version():
+    row = db.session.execute(
+        select(CatalogVersion.version, CatalogVersion.updated_at).where(CatalogVersion.id == 1)
+    ).first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+def bump_catalog_version():
+    # call it before the commit of a catalog write so both land in the same transaction,
+    # the catalog caches of every worker are cleared once it commits
+    now = utcnow()
+    result = db.session.execute(
+        update(CatalogVersion)
+        .where(CatalogVersion.id == 1)
+        .values(version=CatalogVersion.version + 1, updated_at=now)
+    )
+    if result.rowcount == 0:
+        db.session.add(CatalogVersion(id=1, version=1, updated_at=now))
+    invalidate_on_commit(CATALOG_CHANNEL)
+
+
+def catalog_etag(version):
+    # the version changes on every catalog write, the digest tells apart the urls/query strings
+    args = "&".join(f"{key}={value}" for key, value in sorted(request.args.items(multi=True)))
+    digest = hashlib.sha1(f"{request.path}?{args}".encode("utf-8")).hexdigest()[:16]
+    return f"catalog-{version}-{digest}"
+
+
+def conditional_catalog_get(view):
+    """
+    Adds a weak ETag and Last-Modified to a catalog read endpoint and answers
+    304 Not Modified, without running the view, when the client copy is current.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = get_catalog_version()
+        etag = catalog_etag(version)
+        last_modified = updated_at.replace(tzinfo=timezone.utc, microsecond=0) if updated_at else None
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = (last_modified is not None and request.if_modified_since is not None
+                            and last_modified <= request.if_modified_since)
+
+        if not_modified:
+            response = make_response("", 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # shared caches may keep it, but always have to revalidate with the ETag
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
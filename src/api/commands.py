@@ -1,7 +1,14 @@
 
 import click
-import json
-from api.models import db, User, Products
+from flask import current_app
+from api.models import db
+from api.importer import import_products
+from api.search import create_search_index
+from api.stripe_sync import sync_prices, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+from api.webhooks import reprocess_events
+from api.stock import sweep_expired_holds, SWEEP_BATCH_SIZE
+from api.assets import compress_assets
+from api.seed import seed_database, SEED_PASSWORD, DEFAULT_BATCH_SIZE as SEED_BATCH_SIZE
 
 """
 In this file, you can add as many commands as you want using the @app.cli.command decorator
@@ -10,6 +17,24 @@ with youy database, for example: Import the price of bitcoin every night as 12am
 """
 
 
+class MigrateCommands(click.Group):
+    # flask_migrate imports alembic, only `flask db ...` pays for it
+    def make_context(self, info_name, args, parent=None, **extra):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as migrate_group
+        app = current_app._get_current_object()
+        if 'migrate' not in app.extensions:
+            Migrate(app, db, compare_type=True)
+        return migrate_group.make_context(info_name, args, parent=parent, **extra)
+
+
+class BenchCommands(click.Group):
+    # the benchmarks (http.client, subprocess, the fake Stripe...) are only imported by `flask bench ...`
+    def make_context(self, info_name, args, parent=None, **extra):
+        from api.benchmarks import bench
+        return bench.make_context(info_name, args, parent=parent, **extra)
+
+
 def setup_commands(app):
     """
     This is an example command "insert-test-users" that you can run from the command line
@@ -20,38 +45,116 @@ def setup_commands(app):
     @click.argument("count")  # argument of out command
     def insert_test_users(count):
         print("Creating test users")
-        for x in range(1, int(count) + 1):
-            user = User()
-            user.email = "test_user" + str(x) + "@test.com"
-            user.password = "123456"
-            user.is_active = True
-            db.session.add(user)
-            db.session.commit()
-            print("User: ", user.email, " created.")
-
-        print("All test users created")
+        #todos en un solo INSERT, con la misma contraseña ya hasheada
+        seed_database(users=int(count), products=0, password="123456")
+        print("All test users created, password: 123456")
 
     @app.cli.command("insert-test-data")
     def insert_test_data():
-        pass
+        """A few users, products, favorites, carts and orders, see `flask seed` for more"""
+        seed_database(users=10, products=50)
+        print(f"All test data created, password: {SEED_PASSWORD}")
 
+    @app.cli.command("seed")
+    @click.option("--users", default=1000, show_default=True)
+    @click.option("--products", default=1000, show_default=True)
+    @click.option("--favorites", default=5.0, show_default=True, help="Favorites per user, on average")
+    @click.option("--cart", default=2.0, show_default=True, help="Cart lines per user, on average")
+    @click.option("--orders", default=1.0, show_default=True, help="Orders per user, on average")
+    @click.option("--lines", default=3.0, show_default=True, help="Lines per order, on average")
+    @click.option("--skew", default=1.1, show_default=True, help="Zipf exponent of product popularity and user activity")
+    @click.option("--seed", "random_seed", default=42, show_default=True, help="Same seed, same rows")
+    @click.option("--batch-size", default=SEED_BATCH_SIZE, show_default=True, help="Rows per INSERT / COPY")
+    def seed(users, products, favorites, cart, orders, lines, skew, random_seed, batch_size):
+        """Synthetic users, products, favorites, carts and orders with a realistic skew, for load tests"""
+        try:
+            seed_database(users=users, products=products, favorites=favorites, cart=cart, orders=orders, lines=lines,
+                          skew=skew, seed=random_seed, batch_size=batch_size)
+            print(f"Password of every seeded user: {SEED_PASSWORD}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error seeding the database: {e}")
+            raise SystemExit(1)
 
     @app.cli.command("products")
-    def products():
+    @click.argument("path", default="public/products.json")
+    @click.option("--batch-size", default=1000, show_default=True, help="Products written per transaction")
+    @click.option("--format", "fmt", type=click.Choice(["auto", "json", "ndjson"]), default="auto", show_default=True)
+    @click.option("--restart", is_flag=True, help="Ignore the checkpoint left by a failed run")
+    @click.option("--state-dir", type=click.Path(file_okay=False), help="Checkpoints directory [default: instance folder]")
+    def products(path, batch_size, fmt, restart, state_dir):
+        """Imports (or updates, matching by name) the products of a JSON array or NDJSON file"""
         try:
-                with open("public/products.json") as f:
-                    data = json.load(f)
-                    for product in data:
-                        new_product = Products(
-                            name=product["name"],
-                            description=product["description"],
-                            img=product["img"],
-                            brand=product["brand"],
-                            type=product["type"],
-                            price=product["price"],
-                        )
-                        db.session.add(new_product)
-                    db.session.commit()
-                    print("Products added to the database")
+            result = import_products(path, state_dir or app.instance_path, batch_size=batch_size, fmt=fmt,
+                                     resume=not restart)
+            print(f"{result['records']} products imported in {result['seconds']:.2f}s")
+            if result['rejected']:
+                print(f"{result['rejected']} records rejected, see the messages above")
         except Exception as e:
+            db.session.rollback()
             print(f"Error loading products: {e}")
+            print("Run the same command again to resume from the last committed batch")
+            raise SystemExit(1)
+
+    @app.cli.command("search-index")
+    def search_index():
+        """Creates (or rebuilds) the full-text search index of the products table"""
+        create_search_index()
+        print("Search index ready")
+
+    @app.cli.command("stripe-sync-prices")
+    @click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True, help="Products committed per batch")
+    @click.option("--workers", default=DEFAULT_WORKERS, show_default=True, help="Concurrent Stripe calls")
+    def stripe_sync_prices(batch_size, workers):
+        """Creates the Stripe Product / Price of every product without one or whose price changed"""
+        def report(synced, failed):
+            print(f"{synced} synced, {failed} failed")
+
+        result = sync_prices(batch_size=batch_size, workers=workers, report=report)
+        print(f"Done: {result['synced']} products synced, {result['failed']} failed")
+        if result['failed']:
+            raise SystemExit(1)
+
+    @app.cli.command("stripe-reprocess-events")
+    @click.argument("event_ids", nargs=-1)
+    def stripe_reprocess_events(event_ids):
+        """Processes again the failed (or stuck) Stripe webhook events, or the given event ids"""
+        result = reprocess_events(list(event_ids) or None)
+        print(f"{result['processed']} events processed, {result['failed']} failed")
+        if result['failed']:
+            raise SystemExit(1)
+
+    @app.cli.command("stock-sweep")
+    @click.option("--batch-size", default=SWEEP_BATCH_SIZE, show_default=True, help="Holds released per transaction")
+    def stock_sweep(batch_size):
+        """Gives back the stock of the expired checkout holds, run it every few minutes"""
+        released = sweep_expired_holds(batch_size=batch_size)
+        print(f"{released} units of stock released")
+
+    @app.cli.command("compress-assets")
+    def compress_static_assets():
+        """Writes .gz (and .br with the brotli package) siblings of the frontend files, run it after the build"""
+        manifest = app.extensions["assets"]
+        written = compress_assets(manifest.static_dir)
+        print(f"{written} compressed files written in {manifest.static_dir}")
+
+    @app.cli.command("fake-stripe")
+    @click.option("--host", default="127.0.0.1", show_default=True)
+    @click.option("--port", default=12111, show_default=True)
+    @click.option("--delay", default=0.0, show_default=True, help="Seconds added to every write")
+    @click.option("--fail-rate", default=0.0, show_default=True, help="Fraction of writes answered with a 500")
+    def fake_stripe(host, port, delay, fail_rate):
+        """Runs a local fake of the Stripe API, use it with STRIPE_API_BASE"""
+        from api.fake_stripe import FakeStripeServer
+        server = FakeStripeServer((host, port), delay=delay, fail_rate=fail_rate)
+        print(f"Fake Stripe listening on {server.url}, export STRIPE_API_BASE={server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    # benchmarks and stress checks: flask bench --help
+    app.cli.add_command(BenchCommands("bench", help="Benchmarks and stress checks"))
+
+    # flask db upgrade, migrate, ...
+    app.cli.add_command(MigrateCommands("db", help="Perform database migrations."))
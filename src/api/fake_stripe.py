@@ -0,0 +1,154 @@
+"""
+A local stand-in for the parts of the Stripe API the app uses, for tests and
+benchmarks. Point the app at it with STRIPE_API_BASE=http://127.0.0.1:<port>.
+
+It stores every created object in memory, answers repeated Idempotency-Keys
+with the first response like Stripe does (and rejects a key reused with other
+params, also like Stripe), and can add latency (--delay) or fail a fraction
+of the requests with a 500 (--fail-rate).
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# path of the collection -> (object name, id prefix)
+RESOURCES = {
+    "checkout/sessions": ("checkout.session", "cs_test_"),
+    "products": ("product", "prod_"),
+    "prices": ("price", "price_"),
+}
+
+
+def parse_form(body):
+    # stripe sends nested params as line_items[0][price_data][currency]=usd
+    result = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = key.replace("]", "").split("[")
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _to_lists(result)
+
+
+def _to_lists(value):
+    if not isinstance(value, dict):
+        return value
+    if value and all(key.isdigit() for key in value):
+        return [_to_lists(value[key]) for key in sorted(value, key=int)]
+    return {key: _to_lists(item) for key, item in value.items()}
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay=0.0, fail_rate=0.0):
+        super().__init__(address, FakeStripeHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.objects = {}
+        self.idempotent_responses = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _resource(self):
+        path = self.path.split("?", 1)[0].strip("/")
+        if not path.startswith("v1/"):
+            return None, None
+        path = path[3:]
+        for collection in RESOURCES:
+            if path == collection:
+                return collection, None
+            if path.startswith(collection + "/"):
+                return collection, path[len(collection) + 1:]
+        return None, None
+
+    def do_GET(self):
+        collection, object_id = self._resource()
+        obj = self.server.objects.get(object_id) if object_id else None
+        if obj is None:
+            return self._send(404, {"error": {"type": "invalid_request_error", "message": "No such object"}})
+        self._send(200, obj)
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        length = int(self.headers.get("Content-Length") or 0)
+        params = parse_form(self.rfile.read(length).decode("utf-8"))
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        key = self.headers.get("Idempotency-Key")
+        with server.lock:
+            if key and key in server.idempotent_responses:
+                first_params, response = server.idempotent_responses[key]
+                if first_params != params:
+                    return self._send(400, {"error": {
+                        "type": "idempotency_error",
+                        "message": f"Keys for idempotent requests can only be used with the same parameters "
+                                   f"they were first used with. Try using a key other than '{key}' if you "
+                                   f"meant to execute a different request.",
+                    }})
+                return self._send(*response)
+
+        if server.fail_rate and random.random() < server.fail_rate:
+            return self._send(500, {"error": {"type": "api_error", "message": "Injected failure"}})
+
+        collection, object_id = self._resource()
+        if collection is None:
+            return self._send(404, {"error": {"type": "invalid_request_error", "message": "Unrecognized request URL"}})
+
+        # POST checkout/sessions/<id>/expire
+        object_id, _, action = (object_id or "").partition("/")
+        with server.lock:
+            if object_id:
+                obj = server.objects.get(object_id)
+                if obj is None:
+                    return self._send(404, {"error": {"type": "invalid_request_error", "message": "No such object"}})
+                if action == "expire":
+                    obj.update(status="expired")
+                else:
+                    obj.update(params)
+            else:
+                name, prefix = RESOURCES[collection]
+                object_id = prefix + uuid.uuid4().hex[:24]
+                obj = dict(params, id=object_id, object=name, created=int(time.time()), livemode=False)
+                if name == "checkout.session":
+                    obj.update(url=f"{server.url}/pay/{object_id}", status="open", payment_status="unpaid")
+                if name == "price":
+                    obj.setdefault("active", True)
+                server.objects[object_id] = obj
+            response = (200, dict(obj))
+            if key:
+                server.idempotent_responses[key] = (params, response)
+        self._send(*response)
+
+
+def start_fake_stripe(host="127.0.0.1", port=0, delay=0.0, fail_rate=0.0):
+    server = FakeStripeServer((host, port), delay=delay, fail_rate=fail_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
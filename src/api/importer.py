@@ -0,0 +1,276 @@
+"""
+Streaming, idempotent product importer used by `flask products`.
+
+The source file (a JSON array or NDJSON, one product per line) is read
+incrementally and written in batches: COPY into a temporary table plus one
+INSERT ... ON CONFLICT (name) DO UPDATE on Postgres, a multi-row upsert on
+SQLite. Rows are matched on the unique products.name, so a rerun updates
+instead of failing; the stock of an existing product is only overwritten by a
+record that has one. Records that are not a valid product are rejected and
+reported, the rest of the file is still imported. After every committed batch
+a checkpoint file in the state directory (the app's instance folder by
+default, never next to a source that may be served from public/) records how
+many records are done; a failed run resumes from there.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from api.models import db, Products
+from api.catalog import bump_catalog_version
+
+READ_CHUNK_SIZE = 64 * 1024
+# rejected records reported one by one, the rest only counted
+MAX_REPORTED_REJECTIONS = 20
+
+# columns written by the importer, "name" is the upsert key
+IMPORT_COLUMNS = ("name", "description", "img", "brand", "type", "price", "stock")
+UPDATE_COLUMNS = tuple(column for column in IMPORT_COLUMNS if column != "name")
+# a record without a stock leaves the live inventory (and its stock holds) alone, it only starts at 0 on insert
+UPDATE_COLUMNS_KEEP_STOCK = tuple(column for column in UPDATE_COLUMNS if column != "stock")
+
+
+class ProductImportError(ValueError):
+    pass
+
+
+def iter_json_array(f):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # skip whitespace, the opening bracket and the commas between items
+        while position < len(buffer) and buffer[position] in " \t\r\n,[":
+            if buffer[position] == "[":
+                started = True
+            position += 1
+
+        if position < len(buffer) and buffer[position] == "]":
+            return
+
+        if position < len(buffer):
+            if not started:
+                raise ProductImportError("Expected a JSON array")
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield record
+                position = end
+                continue
+
+        if eof:
+            raise ProductImportError("Unterminated JSON array")
+        chunk = f.read(READ_CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_ndjson(f):
+    for number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as error:
+            raise ProductImportError(f"Line {number}: {error}")
+
+
+def iter_records(f, fmt="auto"):
+    if fmt == "auto":
+        # an array starts with "[", anything else is one object per line
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        fmt = "json" if first == "[" else "ndjson"
+        f.seek(0)
+    return iter_json_array(f) if fmt == "json" else iter_ndjson(f)
+
+
+def _number(record, key, default=None):
+    value = record.get(key)
+    if value in (None, "") and default is not None:
+        return default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ProductImportError(f"Product {record.get('name')!r} has an invalid {key} {value!r}")
+    if number != number or number in (float("inf"), float("-inf")):
+        raise ProductImportError(f"Product {record.get('name')!r} has an invalid {key} {value!r}")
+    return number
+
+
+def normalize(record):
+    if not isinstance(record, dict):
+        raise ProductImportError(f"Expected a product object, got {type(record).__name__}")
+    missing = [key for key in ("name", "description", "img", "brand", "type", "price") if record.get(key) in (None, "")]
+    if missing:
+        raise ProductImportError(f"Product {record.get('name')!r} is missing {', '.join(missing)}")
+    row = {
+        "name": str(record["name"]),
+        "description": str(record["description"]),
+        "img": str(record["img"]),
+        "brand": str(record["brand"]),
+        "type": str(record["type"]),
+        "price": _number(record, "price"),
+    }
+    if record.get("stock") not in (None, ""):
+        # "12", 12 and "12.0" are the same stock, "12.5" is not a stock
+        stock = _number(record, "stock")
+        if not float(stock).is_integer():
+            raise ProductImportError(f"Product {record.get('name')!r} has an invalid stock {record.get('stock')!r}")
+        row["stock"] = max(int(stock), 0)
+    return row
+
+
+def _dedupe(rows):
+    # a single upsert statement cannot touch the same name twice, the last one wins
+    return list({row["name"]: row for row in rows}.values())
+
+
+def _copy_upsert(rows, update_columns):
+    connection = db.session.connection()
+    cursor = connection.connection.dbapi_connection.cursor()
+    columns = ", ".join(IMPORT_COLUMNS)
+    cursor.execute(
+        "CREATE TEMP TABLE products_import "
+        "(name varchar(120), description varchar(400), img varchar(500), brand varchar(120), "
+        "type varchar(120), price double precision, stock integer) ON COMMIT DROP"
+    )
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow([row[column] for column in IMPORT_COLUMNS])
+    data.seek(0)
+    cursor.copy_expert(f"COPY products_import ({columns}) FROM STDIN WITH (FORMAT csv)", data)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    cursor.execute(
+        f"INSERT INTO products ({columns}) SELECT {columns} FROM products_import "
+        f"ON CONFLICT (name) DO UPDATE SET {updates}"
+    )
+    # the batch may run a second upsert in the same transaction
+    cursor.execute("DROP TABLE products_import")
+    cursor.close()
+
+
+def _statement_upsert(rows, dialect, update_columns):
+    stmt = (postgresql if dialect == "postgresql" else sqlite).insert(Products.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={column: stmt.excluded[column] for column in update_columns},
+    )
+    db.session.execute(stmt, rows)
+
+
+def upsert_products(rows):
+    rows = _dedupe(rows)
+    # one upsert for the records that carry a stock and one, that keeps it, for those that do not
+    groups = (
+        ([row for row in rows if "stock" in row], UPDATE_COLUMNS),
+        ([dict(row, stock=0) for row in rows if "stock" not in row], UPDATE_COLUMNS_KEEP_STOCK),
+    )
+    dialect = db.engine.dialect.name
+    for group, update_columns in groups:
+        if not group:
+            continue
+        if dialect == "postgresql" and db.engine.dialect.driver == "psycopg2":
+            _copy_upsert(group, update_columns)
+        elif dialect in ("postgresql", "sqlite"):
+            _statement_upsert(group, dialect, update_columns)
+        else:
+            # no portable upsert, plain inserts still make a fresh load fast
+            db.session.execute(insert(Products.__table__), group)
+
+
+def _checkpoint_path(path, state_dir):
+    # one file per source, named after its absolute path
+    source = os.path.abspath(path)
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(state_dir, f"{os.path.basename(source)}.{digest}.import-state")
+
+
+def _source_signature(path):
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_checkpoint(path, state_dir):
+    try:
+        with open(_checkpoint_path(path, state_dir)) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return 0
+    signature = _source_signature(path)
+    if any(state.get(key) != value for key, value in signature.items()):
+        # the file changed since the failed run, start over (the upsert makes it safe)
+        return 0
+    return int(state.get("records_done", 0))
+
+
+def write_checkpoint(path, state_dir, records_done):
+    state = dict(_source_signature(path), records_done=records_done)
+    checkpoint = _checkpoint_path(path, state_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, checkpoint)
+
+
+def clear_checkpoint(path, state_dir):
+    try:
+        os.remove(_checkpoint_path(path, state_dir))
+    except FileNotFoundError:
+        pass
+
+
+def import_products(path, state_dir, batch_size=1000, fmt="auto", resume=True, report=print):
+    skip = read_checkpoint(path, state_dir) if resume else 0
+    if skip:
+        report(f"Resuming after {skip} records already imported")
+
+    started = time.perf_counter()
+    done = skip
+    rejected = 0
+    batch = []
+
+    def flush():
+        upsert_products(batch)
+        bump_catalog_version()
+        db.session.commit()
+        write_checkpoint(path, state_dir, done)
+        elapsed = time.perf_counter() - started
+        report(f"{done} records read ({(done - skip) / elapsed:,.0f} records/s)")
+
+    with open(path, encoding="utf-8") as f:
+        for index, record in enumerate(iter_records(f, fmt)):
+            if index < skip:
+                continue
+            done += 1
+            try:
+                batch.append(normalize(record))
+            except ProductImportError as error:
+                rejected += 1
+                if rejected <= MAX_REPORTED_REJECTIONS:
+                    report(f"Record {index + 1} rejected: {error}")
+                continue
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+
+    clear_checkpoint(path, state_dir)
+    elapsed = time.perf_counter() - started
+    return {"records": done - skip - rejected, "rejected": rejected, "seconds": elapsed}
@@ -0,0 +1,136 @@
+"""
+Per-request SQL instrumentation on the SQLAlchemy engine events.
+
+Every request counts its statements and the time spent in the database and
+flags statements repeated SQL_N_PLUS_ONE_THRESHOLD times or more (the usual
+N+1 pattern). In debug mode the numbers go to X-SQL-* response headers, in
+production to the "api.sql" logger. A streamed body (stream_json_array) runs
+its queries after the headers are sent: those requests are counted and logged
+when the response is closed, and never get the headers. For tests:
+
+    with assert_max_queries(2):
+        client.get('/api/products')
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger("api.sql")
+
+_local = threading.local()
+
+# endpoint -> {"requests", "queries", "seconds"} for this worker
+ENDPOINT_STATS = {}
+_endpoint_lock = threading.Lock()
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[" ".join(statement.split())] += 1
+
+    def repeated(self, threshold):
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    def report(self):
+        return "\n".join(f"{count}x {statement}" for statement, count in self.statements.most_common())
+
+
+def _collectors():
+    collectors = list(getattr(_local, "collectors", ()))
+    if has_app_context() and "sql_stats" in g:
+        collectors.append(g.sql_stats)
+    return collectors
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    for stats in _collectors():
+        stats.add(statement, elapsed)
+
+
+@contextmanager
+def count_queries():
+    stats = QueryStats()
+    collectors = _local.__dict__.setdefault("collectors", [])
+    collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    with count_queries() as stats:
+        yield stats
+    assert stats.count <= limit, f"{stats.count} SQL statements, expected at most {limit}:\n{stats.report()}"
+
+
+def setup_instrumentation(app):
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 3)
+
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(name)s: %(message)s"))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = QueryStats()
+
+    def record_sql_stats(stats, method, endpoint, response=None):
+        with _endpoint_lock:
+            totals = ENDPOINT_STATS.setdefault(endpoint, {"requests": 0, "queries": 0, "seconds": 0.0})
+            totals["requests"] += 1
+            totals["queries"] += stats.count
+            totals["seconds"] += stats.seconds
+
+        repeated = stats.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        if app.debug and response is not None:
+            response.headers["X-SQL-Queries"] = str(stats.count)
+            response.headers["X-SQL-Time-ms"] = f"{stats.seconds * 1000:.2f}"
+            response.headers["X-SQL-Repeated"] = str(len(repeated))
+        else:
+            log.info("%s %s: %d queries, %.2f ms", method, endpoint, stats.count, stats.seconds * 1000)
+        for statement, count in repeated:
+            log.warning("Possible N+1 in %s: %d x %s", endpoint, count, statement[:200])
+
+    @app.after_request
+    def report_sql_stats(response):
+        endpoint = request.endpoint or request.path
+        if response.is_streamed:
+            # the body has not run its queries yet, g.sql_stats keeps collecting them while it
+            # streams (stream_with_context) and they are recorded once it is sent
+            stats = g.get("sql_stats")
+            if stats is not None:
+                method = request.method
+                response.call_on_close(lambda: record_sql_stats(stats, method, endpoint))
+            return response
+
+        stats = g.pop("sql_stats", None)
+        if stats is not None:
+            record_sql_stats(stats, request.method, endpoint, response)
+        return response
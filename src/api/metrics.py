@@ -0,0 +1,143 @@
+"""
+Prometheus metrics, served at /metrics in the text exposition format.
+
+Covers request counts, latency histograms and status codes per blueprint and
+route, the SQLAlchemy connection pool (checkout wait, size, connections in
+use), cache lookups per cache (hit ratio = hit / (hit + miss)) and the
+latency of the outbound Stripe calls.
+
+With several gunicorn workers, export PROMETHEUS_MULTIPROC_DIR pointing to an
+empty directory before the app starts: every worker writes its samples there
+and /metrics aggregates all of them, whichever worker answers the scrape.
+gunicorn's child_exit hook has to call mark_worker_dead(pid).
+"""
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, Response
+from sqlalchemy import event
+from prometheus_client import (
+    Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess,
+)
+from api.models import db
+from api import cache
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests", ["blueprint", "route", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["blueprint", "route", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time waiting for a connection from the SQLAlchemy pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_SIZE = Gauge(
+    "db_pool_size", "Configured size of the SQLAlchemy pool", multiprocess_mode="livesum",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Connections currently checked out of the SQLAlchemy pool", multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total", "Cache lookups", ["cache", "result"],
+)
+STRIPE_LATENCY = Histogram(
+    "stripe_request_duration_seconds", "Latency of the calls to the Stripe API", ["operation", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+
+@contextmanager
+def stripe_call(operation):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        STRIPE_LATENCY.labels(operation, outcome).observe(time.perf_counter() - started)
+
+
+def _record_cache_lookup(name, hit):
+    CACHE_LOOKUPS.labels(name, "hit" if hit else "miss").inc()
+
+
+def _time_checkouts(pool):
+    # the pool has no "checkout requested" event, so its internal _do_get is timed
+    do_get = getattr(pool, "_do_get", None)
+    if do_get is None or getattr(pool, "_metrics_timed", False):
+        return
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+    pool._do_get = timed_do_get
+    pool._metrics_timed = True
+
+
+def _instrument_engine(engine):
+    # pool events listened on the engine are carried over to the new pool of engine.dispose()
+    # (the gunicorn workers dispose the pool inherited from the master), so everything here
+    # looks up engine.pool when it runs instead of keeping the pool of today
+    def update_pool_size():
+        pool = engine.pool
+        if hasattr(pool, "size"):
+            DB_POOL_SIZE.set(pool.size())
+
+    def on_connect(*args):
+        # the first connection of a new pool, from then on its checkouts are timed
+        _time_checkouts(engine.pool)
+        update_pool_size()
+
+    def on_checkout(*args):
+        # counted here, checkin fires before the pool takes the connection back
+        DB_POOL_CHECKED_OUT.inc()
+
+    def on_checkin(*args):
+        DB_POOL_CHECKED_OUT.dec()
+
+    event.listen(engine, "connect", on_connect)
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+    _time_checkouts(engine.pool)
+    update_pool_size()
+
+
+def mark_worker_dead(pid):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
+
+def setup_metrics(app):
+    with app.app_context():
+        _instrument_engine(db.engine)
+
+    cache.LOOKUP_LISTENERS.append(_record_cache_lookup)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        blueprint = request.blueprint or "app"
+        REQUEST_LATENCY.labels(blueprint, route, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(blueprint, route, request.method, str(response.status_code)).inc()
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
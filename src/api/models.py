@@ -1,10 +1,31 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, Enum, ForeignKey
+from datetime import datetime, timezone
+from sqlalchemy import String, Boolean, Enum, ForeignKey, DateTime, Text
 from sqlalchemy.orm import Mapped, mapped_column
 
 db = SQLAlchemy()
 
-class User(db.Model):
+
+def utcnow():
+    # naive UTC, the DateTime columns don't store a timezone
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Serializable:
+    # serialized key -> attribute, declared once per model. serialize() reads it from an instance,
+    # projection() selects the same columns labelled with the same keys, so
+    # db.session.execute(select(*Model.projection())).mappings() rows are already serialized
+    serialize_fields = {}
+
+    def serialize(self):
+        return {key: getattr(self, attribute) for key, attribute in self.serialize_fields.items()}
+
+    @classmethod
+    def projection(cls):
+        return [getattr(cls, attribute).label(key) for key, attribute in cls.serialize_fields.items()]
+
+
+class User(Serializable, db.Model):
     __tablename__= "users"
     id: Mapped[int] = mapped_column(primary_key=True)
     user_name: Mapped[int] = mapped_column(String(100), unique=True, nullable=False)
@@ -20,17 +41,16 @@ class User(db.Model):
         return f'<User: {self.id} - {self.email}>'
 
 
-    def serialize(self):
-        return {
-            "user_id": self.id,
-            "user_name": self.user_name,
-            "email": self.email,
-            "is_active": self.is_active,
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "phone": self.phone,
-            "address": self.address
-        }
+    serialize_fields = {
+        "user_id": "id",
+        "user_name": "user_name",
+        "email": "email",
+        "is_active": "is_active",
+        "first_name": "first_name",
+        "last_name": "last_name",
+        "phone": "phone",
+        "address": "address"
+    }
     
     
     favorites = db.relationship("Favorites", back_populates="user")
@@ -39,8 +59,16 @@ class User(db.Model):
 
 
 
-class Products(db.Model):
+class Products(Serializable, db.Model):
     __tablename__= "products"
+    __table_args__ = (
+        # keyset pagination of GET /api/products: (price, id) sort, optionally filtered by brand or type
+        db.Index("ix_products_price_id", "price", "id"),
+        db.Index("ix_products_brand_price_id", "brand", "price", "id"),
+        db.Index("ix_products_type_price_id", "type", "price", "id"),
+        # stock is only taken with UPDATE ... WHERE stock >= n (api.stock), it can never go below zero
+        db.CheckConstraint("stock >= 0", name="ck_products_stock_non_negative"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(120), nullable=False, unique=True)
     description: Mapped[str] = mapped_column(String(400), unique=False, nullable=False)
@@ -48,21 +76,24 @@ class Products(db.Model):
     brand: Mapped[str] = mapped_column(String(120), unique=False, nullable=False)
     type: Mapped[str] = mapped_column(String(120), unique=False, nullable=False)
     price: Mapped[float] = mapped_column(nullable=False)
-    stock: Mapped[str] = mapped_column(String(120), unique=False, nullable=False)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=True)
+    stock: Mapped[int] = mapped_column(nullable=False, default=0, server_default="0")
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=True, index=True)
+    # Stripe Product / Price kept in sync by api.stripe_sync, stripe_price_amount is the price in cents it was created for
+    stripe_product_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    stripe_price_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    stripe_price_amount: Mapped[int] = mapped_column(nullable=True)
 
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "img": self.img,
-            "brand": self.brand,
-            "type": self.type,
-            "price": self.price,
-            "stock": self.stock
-        }
+    serialize_fields = {
+        "id": "id",
+        "name": "name",
+        "description": "description",
+        "img": "img",
+        "brand": "brand",
+        "type": "type",
+        "price": "price",
+        "stock": "stock"
+    }
     
     favorites = db.relationship("Favorites", back_populates="product")
     products_in_order = db.relationship("ProductsInOrder", back_populates="product")
@@ -72,6 +103,10 @@ class Products(db.Model):
 
 class Orders(db.Model):
     __tablename__ = "orders"
+    __table_args__ = (
+        # the paid Stripe Checkout session, a session never becomes two orders
+        db.UniqueConstraint("stripe_session_id", name="uq_orders_stripe_session_id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     subtotal_amount: Mapped[float] = mapped_column(nullable=False)
     total_amount: Mapped[float] = mapped_column(nullable=False)
@@ -80,6 +115,7 @@ class Orders(db.Model):
     city: Mapped[str] = mapped_column(String(120), unique=False, nullable=False)
     postal_code: Mapped[int] = mapped_column(nullable=False)
     country: Mapped[str] = mapped_column(String(120), unique=False, nullable=False)
+    stripe_session_id: Mapped[str] = mapped_column(String(255), nullable=True)
 
 
     def serialize(self):
@@ -102,14 +138,18 @@ class Orders(db.Model):
 class ProductsInOrder(db.Model):
     __tablename__ = "products_in_order"
     id: Mapped[int] = mapped_column(primary_key=True)
-    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False)
-    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False)
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False, index=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False, index=True)
+    quantity: Mapped[int] = mapped_column(nullable=False, default=1, server_default="1")
+    price: Mapped[float] = mapped_column(nullable=True)
 
     def serialize(self):
         return{
             "id": self.id,
             "order_id": self.order_id,
-            "product_id": self.product_id
+            "product_id": self.product_id,
+            "quantity": self.quantity,
+            "price": self.price
         }
     
     product = db.relationship("Products", back_populates="products_in_order")
@@ -120,8 +160,8 @@ class Checkout(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     payment_method: Mapped[str] = mapped_column(String(120), nullable=False, unique=False)
     status: Mapped[str] = mapped_column(Enum("pending", "received", "completed", name="status_transaction"), nullable=False)
-    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False, index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
 
     def serialize(self):
         return{
@@ -136,6 +176,10 @@ class Checkout(db.Model):
 
 class ShoppingCart(db.Model):
     __tablename__ = "shopping_cart"
+    __table_args__ = (
+        # one row per user and product, the target of the add-to-cart upsert
+        db.UniqueConstraint("user_id", "product_id", name="uq_shopping_cart_user_product"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
     cart_id: Mapped[str] = mapped_column(nullable=True)
@@ -159,18 +203,111 @@ class ShoppingCart(db.Model):
             "product_price": product_price 
         }
 
-class Favorites(db.Model):
+class Favorites(Serializable, db.Model):
     __tablename__ = "favorites"
+    __table_args__ = (
+        # one row per user and product; also the index of every favorites lookup by user
+        db.Index("uq_favorites_user_product", "user_id", "product_id", unique=True),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
     product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False)
 
+    serialize_fields = {
+        "id": "id",
+        "user_id": "user_id",
+        "product_id": "product_id"
+    }
+    
+    user = db.relationship("User", back_populates="favorites")
+    product = db.relationship("Products", back_populates="favorites")
+
+
+class CatalogVersion(db.Model):
+    __tablename__ = "catalog_version"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, default=utcnow)
+
+    def serialize(self):
+        return {
+            "version": self.version,
+            "updated_at": self.updated_at.isoformat()
+        }
+
+
+class CheckoutJob(db.Model):
+    __tablename__ = "checkout_jobs"
+    id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    idempotency_key: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    status: Mapped[str] = mapped_column(Enum("pending", "complete", "failed", name="checkout_job_status"), nullable=False, default="pending")
+    stripe_session_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    checkout_url: Mapped[str] = mapped_column(String(1000), nullable=True)
+    error: Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, default=utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, default=utcnow, onupdate=utcnow)
+
+    def serialize(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "checkout_url": self.checkout_url,
+            "session_id": self.stripe_session_id,
+            "error": self.error
+        }
+
+
+class StripeEvent(db.Model):
+    # every webhook event received, the primary key is the Stripe event id so retries are recorded once
+    __tablename__ = "stripe_events"
+    id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    type: Mapped[str] = mapped_column(String(100), nullable=False)
+    status: Mapped[str] = mapped_column(Enum("received", "processed", "ignored", "failed", name="stripe_event_status"), nullable=False, default="received", index=True)
+    payload: Mapped[str] = mapped_column(Text(), nullable=False)
+    error: Mapped[str] = mapped_column(String(500), nullable=True)
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0, server_default="0")
+    received_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, default=utcnow)
+    processed_at: Mapped[datetime] = mapped_column(DateTime(), nullable=True)
+
     def serialize(self):
         return {
             "id": self.id,
+            "type": self.type,
+            "status": self.status,
+            "error": self.error,
+            "attempts": self.attempts,
+            "received_at": self.received_at,
+            "processed_at": self.processed_at
+        }
+
+
+class StockHold(db.Model):
+    # stock taken from Products.stock for a checkout, given back if it is not paid before expires_at
+    __tablename__ = "stock_holds"
+    __table_args__ = (
+        # the sweeper looks for held rows past their expiry
+        db.Index("ix_stock_holds_status_expires_at", "status", "expires_at"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    checkout_job_id: Mapped[str] = mapped_column(ForeignKey("checkout_jobs.id"), nullable=True, index=True)
+    quantity: Mapped[int] = mapped_column(nullable=False)
+    # the unit price when the stock was taken, the price the customer is charged
+    price: Mapped[float] = mapped_column(nullable=True)
+    status: Mapped[str] = mapped_column(Enum("held", "committed", "released", name="stock_hold_status"), nullable=False, default="held")
+    expires_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, default=utcnow)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "product_id": self.product_id,
             "user_id": self.user_id,
-            "product_id": self.product_id
+            "checkout_job_id": self.checkout_job_id,
+            "quantity": self.quantity,
+            "price": self.price,
+            "status": self.status,
+            "expires_at": self.expires_at
         }
-    
-    user = db.relationship("User", back_populates="favorites")
-    product = db.relationship("Products", back_populates="favorites")
\ No newline at end of file
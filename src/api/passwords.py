@@ -0,0 +1,102 @@
+"""
+Password hashing through a bounded executor.
+
+Hashing is deliberately slow, so /login and /register run it on a small pool
+of PASSWORD_HASH_WORKERS threads (hashlib releases the GIL while it works)
+with at most PASSWORD_HASH_QUEUE requests waiting. When the pool is full the
+request fails fast with a 429 instead of piling up and starving the worker.
+
+PASSWORD_HASH_METHOD / PASSWORD_HASH_SALT_LENGTH are passed to werkzeug's
+generate_password_hash. When they change, a successful login transparently
+rehashes the stored password with the new parameters.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from api.utils import APIException
+
+config = {
+    'method': 'scrypt',
+    'salt_length': 16,
+    'workers': 2,
+    'queue': 8,
+    'timeout': 10.0,
+}
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+_pid = None
+_method_prefix = None
+
+
+def _pool():
+    # created on first use and again after a fork, threads do not survive it
+    global _executor, _slots, _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=config['workers'], thread_name_prefix="password-hash")
+                _slots = threading.BoundedSemaphore(config['workers'] + config['queue'])
+                _pid = os.getpid()
+    return _executor, _slots
+
+
+def _run(fn, *args):
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise APIException("Too many login requests, try again in a moment", status_code=429)
+    try:
+        future = executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future.result(timeout=config['timeout'])
+
+
+def _generate(password):
+    return generate_password_hash(password, method=config['method'], salt_length=config['salt_length'])
+
+
+def hash_password(password):
+    return _run(_generate, password)
+
+
+def needs_rehash(password_hash):
+    # werkzeug hashes look like "<method:params>$<salt>$<hash>"
+    global _method_prefix
+    if _method_prefix is None:
+        _method_prefix = _generate("").split("$", 1)[0]
+    parts = password_hash.split("$")
+    return len(parts) != 3 or parts[0] != _method_prefix or len(parts[1]) != config['salt_length']
+
+
+def verify_password(password_hash, password):
+    # returns (valid, new_hash), new_hash is only set when the stored one must be replaced
+    if not _run(check_password_hash, password_hash, password):
+        return False, None
+    if needs_rehash(password_hash):
+        return True, hash_password(password)
+    return True, None
+
+
+def setup_passwords(app):
+    global _method_prefix, _pid
+    app.config.setdefault('PASSWORD_HASH_METHOD', os.getenv('PASSWORD_HASH_METHOD', 'scrypt'))
+    app.config.setdefault('PASSWORD_HASH_SALT_LENGTH', int(os.getenv('PASSWORD_HASH_SALT_LENGTH', 16)))
+    app.config.setdefault('PASSWORD_HASH_WORKERS', int(os.getenv('PASSWORD_HASH_WORKERS', 2)))
+    app.config.setdefault('PASSWORD_HASH_QUEUE', int(os.getenv('PASSWORD_HASH_QUEUE', 8)))
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', float(os.getenv('PASSWORD_HASH_TIMEOUT', 10)))
+
+    config.update(
+        method=app.config['PASSWORD_HASH_METHOD'],
+        salt_length=app.config['PASSWORD_HASH_SALT_LENGTH'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue=app.config['PASSWORD_HASH_QUEUE'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+    )
+    # rebuilt lazily with the new settings
+    _method_prefix = None
+    _pid = None
@@ -0,0 +1,172 @@
+"""
+Stripe Checkout sessions created off the request thread.
+
+POST /api/create-checkout-session stores a CheckoutJob and answers 202 right
+away; a background thread calls Stripe (STRIPE_TIMEOUT seconds per attempt,
+STRIPE_MAX_RETRIES network retries) and the client polls the job until it is
+complete. Jobs are keyed by the cart contents and a user's checkouts are
+serialized on their users row, so double clicks, retries and polls from
+several tabs all end in one job; the Stripe idempotency key is the
+job id, each job sends its own metadata and expiry and gets its own session.
+
+STRIPE_API_BASE points the client at another server, e.g. `flask fake-stripe`.
+"""
+import hashlib
+import json
+import os
+import uuid
+from datetime import timedelta, timezone
+from sqlalchemy import select, exists, update
+from api.models import db, User, CheckoutJob, StockHold, utcnow
+from api.cart import cart_items
+from api.metrics import stripe_call
+from api.stripe_sync import has_synced_price, price_amount
+from api.stock import reserve_stock, release_job_holds
+from api.stripe_client import get_stripe
+from api import background
+
+# a job still pending after this long lost its worker, the client may start another one
+CHECKOUT_JOB_TIMEOUT = timedelta(seconds=60)
+# a job is handed out again only while its session and stock holds have this much time left to be paid
+REUSE_MARGIN = timedelta(minutes=5)
+
+
+def checkout_line_items(items):
+    line_items = []
+    for item in items:
+        if not item.product:
+            print(f"ADVERTENCIA: Producto con ID {item.product_id} no encontrado para el ítem del carrito {item.id}. Saltando este ítem.")
+            continue
+        if has_synced_price(item.product):
+            line_items.append({'price': item.product.stripe_price_id, 'quantity': item.quantity})
+            continue
+        #todavía sin Price en Stripe (o el precio cambió y no se ha sincronizado), se envía inline
+        line_items.append({
+            'price_data': {
+                'currency': 'usd',
+                'product_data': {
+                    'name': item.product.name,
+                },
+                'unit_amount': price_amount(item.product.price),
+            },
+            'quantity': item.quantity,
+        })
+    return line_items
+
+
+def checkout_idempotency_key(user_id, items, line_items):
+    # the cart line ids change once a paid cart is cleared, so a later identical cart gets a new key
+    payload = {
+        'user_id': int(user_id),
+        'lines': sorted([item.id, item.product_id, item.quantity] for item in items),
+        'line_items': line_items,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def holds_alive(job_id):
+    # the session expires with the holds (HOLD_TTL), a job whose holds expired or were released is dead
+    return exists().where(
+        StockHold.checkout_job_id == job_id,
+        StockHold.status == 'held',
+        StockHold.expires_at > utcnow() + REUSE_MARGIN,
+    )
+
+
+def expire_stale(job):
+    if job.status == 'pending' and utcnow() - job.created_at > CHECKOUT_JOB_TIMEOUT:
+        job.status = 'failed'
+        job.error = 'Timed out waiting for Stripe'
+        release_job_holds(job.id)
+        db.session.commit()
+    return job
+
+
+def start_checkout(user):
+    """
+    Returns (job, line_items), job is None when the cart has nothing to pay.
+    An unfinished or complete job for the same cart is reused while its
+    stock holds (and so its Stripe session) are still alive.
+    """
+    # SELECT ... FOR UPDATE on the user row: concurrent checkouts of one user (double clicks, tabs) wait
+    # here until the first one has committed its job, then find it. sqlite ignores it, dev only
+    db.session.execute(select(User.id).filter_by(id=user.id).with_for_update())
+    items = cart_items(user.id)
+    line_items = checkout_line_items(items)
+    if not line_items:
+        db.session.commit()
+        return None, line_items
+
+    key = checkout_idempotency_key(user.id, items, line_items)
+    existing = db.session.scalars(
+        select(CheckoutJob)
+        .filter_by(user_id=user.id, idempotency_key=key)
+        .where(CheckoutJob.status != 'failed', holds_alive(CheckoutJob.id))
+        .order_by(CheckoutJob.created_at.desc())
+    ).first()
+    if existing is not None and expire_stale(existing).status != 'failed':
+        db.session.commit()
+        return existing, line_items
+
+    job = CheckoutJob(id=str(uuid.uuid4()), user_id=user.id, idempotency_key=key, status='pending')
+    db.session.add(job)
+    db.session.flush()
+    # the stock is taken with the job, a 409 rolls both back
+    expires_at = reserve_stock(user.id, [(item.product_id, item.quantity) for item in items if item.product], job.id)
+    db.session.commit()
+
+    background.submit(run_checkout_job, job.id, user.id, user.email, line_items, expires_at)
+    return job, line_items
+
+
+def run_checkout_job(job_id, user_id, email, line_items, expires_at):
+    try:
+        with stripe_call('checkout.Session.create'):
+            session = get_stripe().checkout.Session.create(
+                payment_method_types=['card'],
+                mode='payment',
+                line_items=line_items,
+                success_url=os.environ.get('FRONTEND_SUCCESS_URL', 'https://tupagina.com/success'),
+                cancel_url=os.environ.get('FRONTEND_CANCEL_URL', 'https://tupagina.com/cancel'),
+                customer_email=email or None,
+                client_reference_id=str(user_id),
+                metadata={'user_id': str(user_id), 'checkout_job_id': job_id},
+                # the session cannot be paid once the stock holds are gone
+                expires_at=int(expires_at.replace(tzinfo=timezone.utc).timestamp()),
+                # network retries of this job resend the same params, a new job for the same cart
+                # sends another job id and expiry and needs a key of its own
+                idempotency_key=f"checkout-session-{job_id}",
+            )
+        values = {'status': 'complete', 'stripe_session_id': session.id, 'checkout_url': session.url}
+    except Exception as error:
+        print(f"ERROR: Error al crear la sesión de checkout: {error}")
+        values = {'status': 'failed', 'error': str(error)[:500]}
+
+    # only a job still pending takes the result, expire_stale may have failed it and given its stock back
+    # while Stripe was answering
+    updated = db.session.execute(
+        update(CheckoutJob).where(CheckoutJob.id == job_id, CheckoutJob.status == 'pending').values(**values)
+    ).rowcount == 1
+    if updated and values['status'] == 'failed':
+        release_job_holds(job_id)
+    db.session.commit()
+
+    if not updated and values['status'] == 'complete':
+        # nothing is held for this session any more, it must not be paid
+        expire_session(values['stripe_session_id'])
+
+
+def expire_session(session_id):
+    try:
+        with stripe_call('checkout.Session.expire'):
+            get_stripe().checkout.Session.expire(session_id)
+    except Exception as error:
+        print(f"ERROR: No se pudo expirar la sesión de checkout {session_id}: {error}")
+
+
+def get_checkout_job(job_id, user_id):
+    job = db.session.get(CheckoutJob, job_id)
+    if job is None or job.user_id != int(user_id):
+        return None
+    return expire_stale(job)
+
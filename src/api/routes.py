@@ -3,14 +3,20 @@ This module takes care of starting the API Server, Loading the DB and Adding the
 """
 from flask import Flask, request, jsonify, url_for, Blueprint
 from api.models import db, User, Products, Favorites, Checkout, ShoppingCart
-from api.utils import generate_sitemap, APIException
+from api.utils import generate_sitemap, APIException, stream_json_array
+from api.catalog import parse_product_filters, list_products, iter_products, get_product_data, STREAM_BATCH_SIZE, bump_catalog_version, conditional_catalog_get
+from api.cache import cache_stats
+from api.search import search_products
+from api.cart import add_to_cart, parse_cart_operations, apply_cart_operations, cart_items, dialect_insert
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import joinedload
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
+from api.passwords import hash_password, verify_password
+from api.auth import invalidate_user
+from api.payments import start_checkout, get_checkout_job
+from api.stripe_sync import schedule_price_sync
+from api.webhooks import verify_event, receive_event
+from sqlalchemy import select
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request, current_user
 import datetime
-import stripe
-import os
 
 api = Blueprint('api', __name__)
 
@@ -37,6 +43,12 @@ def handle_hello():
     return jsonify(response_body), 200
 
 
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    #contadores de hits/misses de las caches de este worker
+    return jsonify(cache_stats()), 200
+
+
 #USER SETTINGS
 
 
@@ -45,7 +57,7 @@ def handle_hello():
 def get_current_user():
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = current_user
 
         if not user:
             return jsonify({"msg": "User not found"}), 404
@@ -83,7 +95,7 @@ def register():
 
         new_user = User(
             email=email,
-            password=generate_password_hash(password),
+            password=hash_password(password),
             user_name=user_name,
             first_name=first_name,
             last_name=last_name,
@@ -102,6 +114,9 @@ def register():
 
         return {'msg': 'okey', 'token': access_token, 'user': new_user.serialize()}, 201
 
+    except APIException:
+        db.session.rollback()
+        raise
     except Exception as error:
         db.session.rollback()
         return jsonify({'error': str(error)}), 400
@@ -146,7 +161,8 @@ def update_user(user_id):
         if address:
             user.address = address
 
-        # Guardar cambios
+        # Guardar cambios (y sacar al usuario de la cache de todos los workers)
+        invalidate_user(user.id)
         db.session.commit()
 
 
@@ -171,6 +187,7 @@ def delete_user(user_id):
         
         #delete user
         db.session.delete(user)
+        invalidate_user(user.id)
         db.session.commit()
 
 
@@ -183,11 +200,13 @@ def delete_user(user_id):
 @api.route('/users', methods=['GET'])
 def get_users():
     try:
-        #dar todos los usuarios
-        users = User.query.all()
-        users_list = [user.serialize() for user in users]
+        #dar todos los usuarios, enviados a medida que se leen de la base de datos
+        def users():
+            rows = db.session.execute(select(*User.projection()).execution_options(yield_per=STREAM_BATCH_SIZE))
+            for user in rows.mappings():
+                yield dict(user)
 
-        return jsonify(users_list), 200
+        return stream_json_array(users()), 200
     
     except Exception as error:
         return jsonify({'error' : str(error)}), 400
@@ -230,9 +249,15 @@ def user_login():
             return jsonify({'msg': 'User not found'}), 404
 
         # Verificar si la contraseña ingresada coincide con el hash almacenado en la base de datos
-        if not check_password_hash(check_user.password, password):
+        valid, new_hash = verify_password(check_user.password, password)
+        if not valid:
             return jsonify({'msg': 'Incorrect password'}), 400
 
+        # Si cambiaron los parametros del hash se guarda de nuevo con los actuales
+        if new_hash:
+            check_user.password = new_hash
+            db.session.commit()
+
         # Si la contraseña es correcta, generar el token de acceso
         expires = datetime.timedelta(days=1)
         access_token = create_access_token(identity=str(check_user.id), expires_delta=expires)
@@ -240,6 +265,8 @@ def user_login():
         # Retornar la respuesta con el token y los datos del usuario
         return jsonify({'msg': 'ok', 'token': access_token, 'user': check_user.serialize()}), 200
 
+    except APIException:
+        raise
     except Exception as error:
         # Manejar cualquier error que pueda ocurrir
         return jsonify({'error': str(error)}), 500
@@ -258,14 +285,17 @@ def create_product():
         brand = request.json.get('brand', None)
         type = request.json.get('type', None)
         price = request.json.get('price', None)
+        stock = request.json.get('stock', 0)
 
         if not all([name or description or img or brand or type or price]):
             return jsonify({'msg': 'Fill all data'}),400
         
         #crear un producto
-        new_product = Products(name=name, description=description, img=img, brand=brand, type=type, price=price)
+        new_product = Products(name=name, description=description, img=img, brand=brand, type=type, price=price, stock=stock)
         db.session.add(new_product)
+        bump_catalog_version()
         db.session.commit()
+        schedule_price_sync(new_product.id)
 
         return jsonify({'msg': 'product created successfully', 'product': new_product.serialize()}), 200
     
@@ -289,10 +319,17 @@ def update_product(product_id):
         product.img = request.json.get('img', product.img)
         product.brand = request.json.get('brand', product.brand)
         product.type = request.json.get('type', product.type)
+        old_price = product.price
         product.price = request.json.get('price', product.price)
+        product.stock = request.json.get('stock', product.stock)
 
+        bump_catalog_version()
         db.session.commit()
 
+        #crear el nuevo Price de Stripe en segundo plano
+        if product.price != old_price:
+            schedule_price_sync(product.id)
+
         return jsonify({'msg': 'product updated successfully', 'product': product.serialize()}), 200
     
     except Exception as error:
@@ -311,6 +348,7 @@ def delete_product(product_id):
         
         #borrar producto
         db.session.delete(product)
+        bump_catalog_version()
         db.session.commit()
 
         return jsonify({'msg': 'Product deleted successfully'}), 200
@@ -321,49 +359,64 @@ def delete_product(product_id):
     
 
 @api.route('/products', methods=['GET'])
+@conditional_catalog_get
 def get_products():
     try:
-        #traer todos los productos
-        products = Products.query.all()
-        print(f"Found {len(products)} products in the database.")
-        products_list = [
-            {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'img': product.img,
-                'brand': product.brand,
-                'type': product.type,
-                'price': product.price
-
-            } for product in products
-        ]
+        #una pagina de productos con filtros (brand, type, min_price, max_price), sort y cursor
+        filters = parse_product_filters(request.args)
+
+        #?stream=1 manda todos los productos que cumplen los filtros como un array en streaming
+        if request.args.get('stream') in ('1', 'true'):
+            return stream_json_array(iter_products(filters)), 200
+
+        page = list_products(filters)
 
-        return jsonify(products_list), 200
+        return jsonify(page), 200
     
+    except APIException:
+        raise
     except Exception as error:
         db.session.rollback()
         return jsonify({'error': str(error)})
     
 
+@api.route('/products/search', methods=['GET'])
+@conditional_catalog_get
+def search_products_route():
+    try:
+        #busqueda por texto en nombre, descripcion y marca, ordenada por relevancia
+        results = search_products(request.args)
+
+        return jsonify(results), 200
+
+    except APIException:
+        raise
+    except Exception as error:
+        db.session.rollback()
+        #el error puede llevar el SQL de la consulta, al cliente solo se le da un mensaje generico
+        print(f"ERROR: Fallo en la búsqueda de productos: {error}")
+        return jsonify({'error': 'Search failed'}), 500
+
+
 @api.route('/products/<int:product_id>', methods=['GET'])
+@conditional_catalog_get
 def get_product(product_id):
     try:
         #traer un producto por su id
-        product = Products.query.get(product_id)
+        product = get_product_data(product_id)
 
         if not product:
             return jsonify({'msg': 'Product not found'}), 404
         
         product_data = [
             {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'img': product.img,
-                'brand': product.brand,
-                'type': product.type,
-                'price': product.price 
+                'id': product['id'],
+                'name': product['name'],
+                'description': product['description'],
+                'img': product['img'],
+                'brand': product['brand'],
+                'type': product['type'],
+                'price': product['price'] 
             }
         ]
 
@@ -382,7 +435,7 @@ def get_product(product_id):
 def add_to_favorites():
     try:
         id = get_jwt_identity()
-        user = User.query.get(id) 
+        user = current_user
 
         if not user:
             return jsonify({'msg': 'User not found'}), 400
@@ -401,12 +454,15 @@ def add_to_favorites():
             db.session.commit()
             return jsonify({'msg' : 'Product deleted'}), 200
         else:
-            #añadir favorito
-            new_favorite = Favorites(product_id=product_id, user_id=id)
-            db.session.add(new_favorite)
+            #añadir favorito, si otra peticion lo acaba de añadir el indice unico lo deja en uno
+            db.session.execute(
+                dialect_insert(Favorites.__table__).values(product_id=product_id, user_id=id)
+                .on_conflict_do_nothing(index_elements=['user_id', 'product_id'])
+            )
             db.session.commit()
 
-            updated_favorite = [fav.product_id for fav in user.favorites]
+            #sin recargar user ni user.favorites despues del commit
+            updated_favorite = db.session.scalars(select(Favorites.product_id).filter_by(user_id=id)).all()
             return jsonify({'msg': 'Favorite created', 'updated_favorite': updated_favorite}), 200
         
     except Exception as error:
@@ -419,7 +475,7 @@ def add_to_favorites():
 def delete_favorite(product_id):
     try:
         id = get_jwt_identity()
-        user = User.query.get(id)
+        user = current_user
 
         if not user:
             return jsonify({'msg': 'User not found'}), 400
@@ -448,16 +504,17 @@ def delete_favorite(product_id):
 def get_favorites():
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = current_user
 
         if not user:
             return jsonify({'msg':'User not found'}),400
         
-        favorites = Favorites.query.filter_by(user_id=user_id).all()
-        favorites_products_id = [favorite.product_id for favorite in favorites]
-
-        favorites_products = Products.query.filter(Products.id.in_(favorites_products_id)).all()
-        favorite_products_list = [product.serialize() for product in favorites_products]
+        #una sola consulta, solo las columnas que se devuelven
+        favorites_products_id = select(Favorites.product_id).where(Favorites.user_id == user.id)
+        favorites_products = db.session.execute(
+            select(*Products.projection()).where(Products.id.in_(favorites_products_id))
+        ).mappings()
+        favorite_products_list = [dict(product) for product in favorites_products]
 
         return jsonify({'favorite_products' : favorite_products_list}), 200
     
@@ -506,13 +563,13 @@ def add_to_checkout():
 def get_shopping_cart():
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = current_user
 
         if not user:
             return jsonify({'msg' : 'User not found'}), 400
 
         
-        shopping_cart_items = ShoppingCart.query.filter_by(user_id=user_id).options(joinedload(ShoppingCart.product)).all()
+        shopping_cart_items = cart_items(user_id)
         
         serialized_cart = [item.serialize() for item in shopping_cart_items]
 
@@ -536,41 +593,57 @@ def add_to_shopping_cart():
         if not product_id:
             return jsonify({'msg': 'Product ID is required'}), 400
 
-        
-        existing_item = ShoppingCart.query.filter_by(user_id=user_id, product_id=product_id).first()
+        if not isinstance(quantity, int) or quantity <= 0:
+            return jsonify({'msg': 'Valid integer quantity greater than 0 is required'}), 400
 
-        if existing_item:
-            
-            existing_item.quantity += quantity
-            db.session.commit()
-            msg = 'Product quantity updated in shopping cart'
-        else:
-            
-            new_item = ShoppingCart(
-                user_id=user_id,
-                product_id=product_id,
-                quantity=quantity 
-            )
-            db.session.add(new_item)
-            db.session.commit()
+        #un solo INSERT ... ON CONFLICT que suma la cantidad si el producto ya estaba
+        new_quantity = add_to_cart(user_id, product_id, quantity)
+        db.session.commit()
+
+        if new_quantity == quantity:
             msg = 'Product added to shopping cart'
+        else:
+            msg = 'Product quantity updated in shopping cart'
 
         
         return jsonify({'msg': msg}), 200
 
     except Exception as error:
-        print(f"Error en add_to_shopping_cart: {error}", exc_info=True)
+        print(f"Error en add_to_shopping_cart: {error}")
         db.session.rollback()
         return jsonify({'error': str(error)}), 400
 
     
 
+@api.route('/shopping-cart', methods=['PATCH'])
+@jwt_required()
+def patch_shopping_cart():
+    try:
+        user_id = get_jwt_identity()
+
+        #lista de operaciones set/increment/remove, aplicadas en orden en una sola transaccion
+        operations = parse_cart_operations(request.get_json(silent=True))
+        apply_cart_operations(user_id, operations)
+        db.session.commit()
+
+        serialized_cart = [item.serialize() for item in cart_items(user_id)]
+
+        return jsonify({'shopping_cart_products': serialized_cart}), 200
+
+    except APIException:
+        raise
+    except Exception as error:
+        print(f"Error en patch_shopping_cart: {error}")
+        db.session.rollback()
+        return jsonify({'error': str(error)}), 400
+
+
 @api.route('/shopping-cart/<int:product_id>', methods=['DELETE'])
 @jwt_required()
 def delete_from_shopping_cart(product_id):
     try:
         id = get_jwt_identity()
-        user = User.query.get(id)
+        user = current_user
 
         if not user:
             return jsonify({'msg': 'User not found'}), 400
@@ -598,7 +671,7 @@ def delete_from_shopping_cart(product_id):
 def update_shopping_cart(product_id):
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = current_user
 
         if not user:
             return jsonify({'msg': 'User not found'}), 400
@@ -626,83 +699,69 @@ def update_shopping_cart(product_id):
         return jsonify({'error': str(error)}), 500
 ##STRIPE
 
+def checkout_job_response(job):
+    #la sesión ya existe, el cliente puede redirigir directamente
+    if job.status == 'complete':
+        return jsonify(job.serialize()), 200
+    if job.status == 'failed':
+        return jsonify({**job.serialize(), 'error': 'Error interno del servidor al crear la sesión de pago.'}), 502
+    #todavía pendiente, el cliente consulta poll_url hasta que termine
+    body = {**job.serialize(), 'poll_url': url_for('api.get_checkout_session_job', job_id=job.id)}
+    return jsonify(body), 202, {'Location': body['poll_url'], 'Retry-After': '1'}
+
+
 @api.route('/create-checkout-session', methods=['POST'])
 @jwt_required()
 def create_checkout_session():
     try:
-       
-        user_id = get_jwt_identity()
-
-        
-        user = User.query.get(user_id) 
-        
-        if not user:
-            
-            print(f"DEBUG: Usuario no encontrado para ID: {user_id}")
-            return jsonify({'error': 'Usuario no encontrado. Por favor, inicia sesión de nuevo.'}), 404 # O 400
-
-        cart_items = ShoppingCart.query.filter_by(user_id=user_id).options(joinedload(ShoppingCart.product)).all()
+        #la llamada a Stripe se hace en segundo plano, aquí solo se crea el trabajo
+        job, line_items = start_checkout(current_user)
 
-        if not cart_items:
+        if job is None:
             return jsonify({'msg': 'El carrito de compras está vacío.'}), 400
 
-        line_items_for_stripe = []
-        for item in cart_items:
-            
-            if not item.product:
-                print(f"ADVERTENCIA: Producto con ID {item.product_id} no encontrado para el ítem del carrito {item.id}. Saltando este ítem.")
-                continue 
-
-            line_items_for_stripe.append({
-                'price_data': {
-                    'currency': 'usd', 
-                    'product_data': {
-                        'name': item.product.name, 
-                        
-                    },
-                    
-                    'unit_amount': int(float(item.product.price) * 100), 
-                },
-                'quantity': item.quantity, 
-            })
-
-        if not line_items_for_stripe:
-            return jsonify({'msg': 'No se encontraron productos válidos en el carrito para procesar el pago.'}), 400
-        print(f"DEBUGGING: Clave API siendo usada para Stripe.create: {stripe.api_key}")
-        # Crear la sesión de Checkout de Stripe
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            mode='payment',
-            line_items=line_items_for_stripe, 
-            success_url=os.environ.get('FRONTEND_SUCCESS_URL', 'https://tupagina.com/success'), 
-            cancel_url=os.environ.get('FRONTEND_CANCEL_URL', 'https://tupagina.com/cancel'),
-            
-            customer_email=user.email if user.email else None 
-        )
-
-        return jsonify({'checkout_url': session.url}), 200 
+        return checkout_job_response(job)
 
+    except APIException:
+        #sin stock suficiente (409), no se reserva nada
+        db.session.rollback()
+        raise
     except Exception as e:
-        
-        print(f"ERROR: Error al crear la sesión de checkout: {e}") 
+        print(f"ERROR: Error al crear la sesión de checkout: {e}")
+        db.session.rollback()
         return jsonify({'error': 'Error interno del servidor al crear la sesión de pago.'}), 500
 
 
+@api.route('/create-checkout-session/<job_id>', methods=['GET'])
+@jwt_required()
+def get_checkout_session_job(job_id):
+    try:
+        job = get_checkout_job(job_id, current_user.id)
 
+        if job is None:
+            return jsonify({'msg': 'Checkout not found'}), 404
 
+        return checkout_job_response(job)
 
-        
-
-
-
-
-        
-
-
-
-
+    except Exception as e:
+        print(f"ERROR: Error al consultar la sesión de checkout: {e}")
+        return jsonify({'error': 'Error interno del servidor al crear la sesión de pago.'}), 500
 
 
+@api.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    try:
+        #verificar la firma con el cuerpo tal cual llegó
+        payload = request.get_data(as_text=True)
+        event = verify_event(payload, request.headers.get('Stripe-Signature'))
 
+        #guardar el evento y responder, el pedido se crea en segundo plano
+        return jsonify(receive_event(event, payload)), 200
 
-        
\ No newline at end of file
+    except APIException:
+        raise
+    except Exception as e:
+        #Stripe reintenta cualquier respuesta que no sea 2xx
+        print(f"ERROR: Error al recibir el webhook de Stripe: {e}")
+        db.session.rollback()
+        return jsonify({'error': 'Error interno del servidor al procesar el webhook.'}), 500
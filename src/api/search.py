@@ -0,0 +1,136 @@
+"""
+Ranked full-text search over products.name, description and brand.
+
+Postgres uses the generated products.search_vector tsvector column and its GIN
+index, SQLite the products_fts FTS5 external-content table, kept up to date by
+triggers. Both are created by the migrations, `flask search-index` creates
+them on a database that was built some other way (db.create_all); until then
+the search answers 503.
+"""
+import re
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from api.models import db, Products
+from api.utils import APIException
+from api.catalog import catalog_cache, catalog_projection
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+POSTGRES_SEARCH_DDL = [
+    """
+    ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('spanish', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(brand, '')), 'B') ||
+        setweight(to_tsvector('spanish', coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_products_search_vector ON products USING gin (search_vector)",
+]
+
+SQLITE_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description, brand,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, description, brand ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+        INSERT INTO products_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END
+    """,
+    "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+]
+
+# bm25 weights for (name, description, brand)
+SQLITE_BM25 = "bm25(products_fts, 10.0, 1.0, 5.0)"
+
+
+def create_search_index():
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statements = POSTGRES_SEARCH_DDL
+    elif dialect == 'sqlite':
+        statements = SQLITE_SEARCH_DDL
+    else:
+        raise RuntimeError(f"Full-text search is not supported on {dialect}")
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def fts5_match(query):
+    # every word must match, as a prefix so partial words still find results
+    words = re.findall(r"\w+", query, re.UNICODE)
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def _ranked_ids(query, limit):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        rows = db.session.execute(text(
+            "SELECT id FROM products, websearch_to_tsquery('spanish', :q) AS query "
+            "WHERE search_vector @@ query "
+            "ORDER BY ts_rank(search_vector, query) DESC, id LIMIT :limit"
+        ), {'q': query, 'limit': limit})
+    elif dialect == 'sqlite':
+        match = fts5_match(query)
+        if not match:
+            return []
+        rows = db.session.execute(text(
+            f"SELECT rowid FROM products_fts WHERE products_fts MATCH :q "
+            f"ORDER BY {SQLITE_BM25}, rowid LIMIT :limit"
+        ), {'q': match, 'limit': limit})
+    else:
+        raise RuntimeError(f"Full-text search is not supported on {dialect}")
+    return [row[0] for row in rows]
+
+
+def _missing_index(error):
+    # sqlite: no such table: products_fts, postgres: column "search_vector" does not exist
+    message = str(error.orig)
+    return 'products_fts' in message or 'search_vector' in message
+
+
+def _load_search(query, limit):
+    try:
+        ids = _ranked_ids(query, limit)
+    except (OperationalError, ProgrammingError) as error:
+        if not _missing_index(error):
+            raise
+        db.session.rollback()
+        print("ERROR: No existe el índice de búsqueda, créalo con `flask db upgrade` o `flask search-index`")
+        raise APIException("Search index unavailable", 503)
+    if not ids:
+        return []
+    rows = db.session.execute(select(*catalog_projection()).where(Products.id.in_(ids))).mappings()
+    products = {row['id']: dict(row) for row in rows}
+    return [products[id] for id in ids if id in products]
+
+
+def search_products(args):
+    query = (args.get('q') or '').strip()
+    if not query:
+        raise APIException("Missing search query 'q'")
+    limit = max(1, min(args.get('limit', DEFAULT_SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT))
+
+    products = catalog_cache.get_or_load(('search', query.lower(), limit), lambda: _load_search(query, limit))
+    return {'products': products, 'query': query}
@@ -0,0 +1,220 @@
+"""
+Synthetic data for load tests, written by `flask seed`.
+
+Generates users, products, favorites, cart lines and paid orders (with their
+ProductsInOrder lines and Checkout rows) with the skew of a real shop:
+product popularity follows a Zipf distribution and the rows per user a
+log-normal one (both shaped by --skew), so a few products collect most
+favorites and sales and a few users do most of the buying. Everything comes
+from one random.Random(--seed): the same arguments on the same database
+write the same rows (the salt of the shared password hash aside).
+
+Rows get their ids from the generator (after the current max id), so the
+children reference their parents without reading anything back, and are
+written --batch-size at a time: COPY on Postgres with psycopg2, multi-row
+INSERTs otherwise. Every user shares one password hash, computed once.
+"""
+import csv
+import io
+import math
+import random
+import time
+from collections import Counter
+from itertools import accumulate
+from sqlalchemy import select, insert, func, text
+from api.models import db, User, Products, Favorites, ShoppingCart, Orders, ProductsInOrder, Checkout
+from api.passwords import hash_password
+from api.catalog import bump_catalog_version
+
+SEED_PASSWORD = "seed-password"
+DEFAULT_BATCH_SIZE = 10000
+
+BRANDS = ["Lavazza", "Illy", "Segafredo", "Marcilla", "Saimaza", "Bonka", "Nespresso", "Starbucks", "Kimbo", "Pellini",
+          "Delta", "Tupinamba", "Baque", "Oquendo", "Cafes La Estrella", "Jurado", "Fortaleza", "Dromedario"]
+TYPES = ["grano", "molido", "capsulas", "soluble", "descafeinado", "monodosis", "ecologico", "especialidad"]
+WORDS = ("cafe arabica robusta tostado natural torrefacto mezcla notas chocolate cereza caramelo frutos secos "
+         "origen altura proceso lavado honey intenso suave cremoso acidez cuerpo aroma colombia brasil etiopia "
+         "kenia guatemala nicaragua espresso filtro moka prensa").split()
+FIRST_NAMES = ["Lucia", "Hugo", "Martina", "Mateo", "Sofia", "Leo", "Julia", "Daniel", "Paula", "Alejandro", "Valeria",
+               "Pablo", "Emma", "Manuel", "Daniela", "Alvaro", "Carla", "Adrian", "Sara", "Mario", "Noa", "Diego"]
+LAST_NAMES = ["Garcia", "Rodriguez", "Gonzalez", "Fernandez", "Lopez", "Martinez", "Sanchez", "Perez", "Gomez",
+              "Martin", "Jimenez", "Ruiz", "Hernandez", "Diaz", "Moreno", "Munoz", "Alvarez", "Romero", "Navarro"]
+STREETS = ["Calle Mayor", "Gran Via", "Calle de Alcala", "Paseo de Gracia", "Avenida de la Constitucion",
+           "Calle Real", "Calle del Sol", "Rambla Nova", "Calle Larios", "Avenida de America"]
+CITIES = ["Madrid", "Barcelona", "Valencia", "Sevilla", "Zaragoza", "Malaga", "Murcia", "Bilbao", "Alicante", "Cordoba"]
+
+USER_COLUMNS = ("id", "user_name", "email", "password", "is_active", "first_name", "last_name", "phone", "address")
+PRODUCT_COLUMNS = ("id", "name", "description", "img", "brand", "type", "price", "stock")
+FAVORITE_COLUMNS = ("user_id", "product_id")
+CART_COLUMNS = ("user_id", "product_id", "quantity")
+ORDER_COLUMNS = ("id", "subtotal_amount", "total_amount", "status", "adress", "city", "postal_code", "country",
+                 "stripe_session_id")
+ORDER_LINE_COLUMNS = ("order_id", "product_id", "quantity", "price")
+CHECKOUT_COLUMNS = ("payment_method", "status", "order_id", "user_id")
+
+
+class ZipfSampler:
+    """Draws items with probability 1 / rank ** skew, the ranks in a random order"""
+
+    def __init__(self, rng, items, skew):
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cum_weights = list(accumulate(1 / rank ** skew for rank in range(1, len(self.items) + 1)))
+
+    def sample(self, k):
+        return self.rng.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+    def distinct(self, k, attempts=20):
+        # the popular items come up again and again, keep drawing until there are k different ones
+        k = min(k, len(self.items))
+        picked = {}
+        for _ in range(attempts):
+            for item in self.sample(k - len(picked)):
+                picked.setdefault(item, None)
+            if len(picked) >= k:
+                break
+        return list(picked)
+
+
+class BatchWriter:
+    """Buffers rows per table, flushed in the order the tables were first used (parents first)"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.counts = Counter()
+        self.copy = db.engine.dialect.name == "postgresql" and db.engine.dialect.driver == "psycopg2"
+
+    def add(self, table, columns, row):
+        rows = self.buffers.setdefault(table, (columns, []))[1]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table, (columns, rows) in self.buffers.items():
+            if not rows:
+                continue
+            if self.copy:
+                self._copy(table, columns, rows)
+            else:
+                db.session.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+            self.counts[table.name] += len(rows)
+            rows.clear()
+        db.session.commit()
+
+    def _copy(self, table, columns, rows):
+        cursor = db.session.connection().connection.dbapi_connection.cursor()
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", data)
+        cursor.close()
+
+
+def next_id(table):
+    return (db.session.scalar(select(func.max(table.c.id))) or 0) + 1
+
+
+def reset_sequences(tables):
+    # the ids were chosen here, the serial sequences must continue after them
+    if db.engine.dialect.name != "postgresql":
+        return
+    for table in tables:
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"(SELECT coalesce(max(id), 1) FROM {table.name}))"
+        ))
+    db.session.commit()
+
+
+# the heaviest user still looks like a person, not like a crawler
+MAX_ACTIVITY_FACTOR = 50
+
+
+def activity(rng, user_ids, average, sigma):
+    # rows per user: log-normal with the requested mean, most users do little and a few a lot
+    if average <= 0:
+        return {}
+    mu = math.log(average) - sigma ** 2 / 2
+    cap = max(int(average * MAX_ACTIVITY_FACTOR), 1)
+    return {user_id: min(int(round(rng.lognormvariate(mu, sigma))), cap) for user_id in user_ids}
+
+
+def seed_database(users=1000, products=1000, favorites=5.0, cart=2.0, orders=1.0, lines=3.0, skew=1.1, seed=42,
+                  batch_size=DEFAULT_BATCH_SIZE, password=SEED_PASSWORD, report=print):
+    """
+    Writes `users` users and `products` products, plus on average `favorites`
+    favorites, `cart` cart lines and `orders` orders (of about `lines` lines)
+    per user. Returns {table name: rows written}.
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    writer = BatchWriter(batch_size)
+    users_table, products_table = User.__table__, Products.__table__
+    orders_table = Orders.__table__
+
+    first_product = next_id(products_table)
+    prices = {}
+    for product_id in range(first_product, first_product + products):
+        brand, kind = rng.choice(BRANDS), rng.choice(TYPES)
+        prices[product_id] = round(max(rng.lognormvariate(2.7, 0.5), 1.0), 2)
+        description = " ".join(rng.choices(WORDS, k=rng.randint(12, 40)))[:400]
+        writer.add(products_table, PRODUCT_COLUMNS, (
+            product_id, f"{brand} {kind} {product_id}", description,
+            f"https://picsum.photos/seed/{product_id}/400/400", brand, kind, prices[product_id], rng.randint(0, 500),
+        ))
+
+    first_user = next_id(users_table)
+    user_ids = range(first_user, first_user + users)
+    addresses = {}
+    password_hash = hash_password(password) if users else None
+    for user_id in user_ids:
+        addresses[user_id] = f"{rng.choice(STREETS)} {rng.randint(1, 200)}, {user_id}"
+        writer.add(users_table, USER_COLUMNS, (
+            user_id, f"seed_user_{user_id}", f"seed_user_{user_id}@seed.local", password_hash, True,
+            rng.choice(FIRST_NAMES), f"{rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}",
+            f"+34 6{user_id:08d}", addresses[user_id],
+        ))
+    writer.flush()
+    if products:
+        bump_catalog_version()
+        db.session.commit()
+    report(f"{users} users and {products} products ({time.perf_counter() - started:.1f}s)")
+
+    if users and products:
+        popular = ZipfSampler(rng, prices, skew)
+
+        for user_id, count in activity(rng, user_ids, favorites, skew).items():
+            for product_id in popular.distinct(count):
+                writer.add(Favorites.__table__, FAVORITE_COLUMNS, (user_id, product_id))
+        for user_id, count in activity(rng, user_ids, cart, skew).items():
+            for product_id in popular.distinct(count):
+                writer.add(ShoppingCart.__table__, CART_COLUMNS, (user_id, product_id, rng.randint(1, 3)))
+        writer.flush()
+        report(f"favorites and carts ({time.perf_counter() - started:.1f}s)")
+
+        order_id = next_id(orders_table)
+        for user_id, count in activity(rng, user_ids, orders, skew).items():
+            for _ in range(count):
+                order_lines = [(product_id, rng.randint(1, 3))
+                               for product_id in popular.distinct(rng.randint(1, max(int(2 * lines) - 1, 1)))]
+                subtotal = round(sum(prices[product_id] * quantity for product_id, quantity in order_lines), 2)
+                writer.add(orders_table, ORDER_COLUMNS, (
+                    order_id, subtotal, subtotal, "paid", addresses[user_id], rng.choice(CITIES),
+                    rng.randint(1000, 52999), "ES", f"cs_seed_{order_id}",
+                ))
+                for product_id, quantity in order_lines:
+                    writer.add(ProductsInOrder.__table__, ORDER_LINE_COLUMNS,
+                               (order_id, product_id, quantity, prices[product_id]))
+                writer.add(Checkout.__table__, CHECKOUT_COLUMNS, ("card", "completed", order_id, user_id))
+                order_id += 1
+        writer.flush()
+
+    reset_sequences([users_table, products_table, orders_table])
+    elapsed = time.perf_counter() - started
+    total = sum(writer.counts.values())
+    report(f"{total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s): "
+           + ", ".join(f"{name} {count:,}" for name, count in writer.counts.items()))
+    return dict(writer.counts)
@@ -0,0 +1,113 @@
+"""
+Stock reservations for checkout.
+
+Stock is taken when the checkout starts, with one conditional
+UPDATE products SET stock = stock - n WHERE id = :id AND stock >= n per cart
+line: the database serializes concurrent buyers on the product row, so a
+product can never be sold twice and nobody waits on a lock held across a
+Stripe call. Each reservation is recorded as a StockHold that expires with
+the Stripe Checkout session (HOLD_TTL); the paid order commits the holds, a
+failed checkout releases them and `flask stock-sweep` gives back the stock of
+the expired ones. Stock is not part of the cached, ETagged catalog
+(api.catalog.catalog_projection), so none of this invalidates it.
+"""
+from collections import Counter
+from datetime import timedelta
+from sqlalchemy import select, update, insert, bindparam
+from api.models import db, Products, StockHold, utcnow
+from api.utils import APIException
+
+# stripe does not accept checkout sessions that expire in less than 30 minutes
+HOLD_TTL = timedelta(minutes=30)
+# the webhook of a payment made right before the session expired may still be on its way
+SWEEP_GRACE = timedelta(minutes=5)
+SWEEP_BATCH_SIZE = 500
+
+products_table = Products.__table__
+
+
+def reserve_stock(user_id, lines, checkout_job_id=None, ttl=HOLD_TTL):
+    """
+    Takes the stock of lines [(product_id, quantity)] in the caller's
+    transaction and returns the expiry of the holds. Raises a 409 APIException
+    when a product does not have enough stock, the caller rolls back.
+    """
+    wanted = Counter()
+    for product_id, quantity in lines:
+        wanted[product_id] += quantity
+    expires_at = utcnow() + ttl
+
+    # always in product id order, two carts sharing products cannot deadlock
+    prices = {}
+    for product_id in sorted(wanted):
+        # the price is read from the row the stock is taken from, the hold keeps what the customer pays
+        taken = db.session.execute(
+            update(products_table)
+            .where(products_table.c.id == product_id, products_table.c.stock >= wanted[product_id])
+            .values(stock=products_table.c.stock - wanted[product_id])
+            .returning(products_table.c.price)
+        ).first()
+        if taken is None:
+            raise APIException('Not enough stock', 409, payload={'product_id': product_id})
+        prices[product_id] = taken.price
+
+    db.session.execute(insert(StockHold), [
+        {'product_id': product_id, 'user_id': user_id, 'checkout_job_id': checkout_job_id,
+         'quantity': quantity, 'price': prices[product_id], 'status': 'held', 'expires_at': expires_at}
+        for product_id, quantity in sorted(wanted.items())
+    ])
+    return expires_at
+
+
+def release_holds(condition):
+    # the status guard makes a hold come back exactly once, whoever else is releasing it
+    released = db.session.execute(
+        update(StockHold)
+        .where(condition, StockHold.status == 'held')
+        .values(status='released')
+        .returning(StockHold.product_id, StockHold.quantity)
+        .execution_options(synchronize_session=False)
+    ).all()
+    quantities = Counter()
+    for product_id, quantity in released:
+        quantities[product_id] += quantity
+    if quantities:
+        db.session.execute(
+            update(products_table)
+            .where(products_table.c.id == bindparam('product_id'))
+            .values(stock=products_table.c.stock + bindparam('quantity')),
+            [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in sorted(quantities.items())],
+        )
+    return sum(quantities.values())
+
+
+def release_job_holds(checkout_job_id):
+    return release_holds(StockHold.checkout_job_id == checkout_job_id)
+
+
+def commit_job_holds(checkout_job_id):
+    return db.session.execute(
+        update(StockHold)
+        .where(StockHold.checkout_job_id == checkout_job_id, StockHold.status == 'held')
+        .values(status='committed')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def sweep_expired_holds(batch_size=SWEEP_BATCH_SIZE, grace=SWEEP_GRACE):
+    """Releases the holds expired more than `grace` ago, batch_size per transaction. Returns the units released"""
+    released = 0
+    while True:
+        # SKIP LOCKED (postgres): two sweepers share the work instead of waiting on each other
+        ids = db.session.scalars(
+            select(StockHold.id)
+            .where(StockHold.status == 'held', StockHold.expires_at < utcnow() - grace)
+            .order_by(StockHold.expires_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not ids:
+            break
+        released += release_holds(StockHold.id.in_(ids))
+        db.session.commit()
+    return released
@@ -0,0 +1,52 @@
+"""
+The stripe package, imported the first time it is used.
+
+Importing stripe takes longer than any other dependency of the app and most
+processes (flask commands, workers that never see a checkout) do not need
+it. configure_stripe only records the settings at startup; get_stripe()
+imports the module and applies them on the first checkout, price sync or
+webhook.
+"""
+import os
+import threading
+
+_settings = {}
+_lock = threading.Lock()
+_stripe = None
+
+
+def configure_stripe(app):
+    global _stripe
+    app.config.setdefault('STRIPE_TIMEOUT', float(os.getenv('STRIPE_TIMEOUT', 10)))
+    app.config.setdefault('STRIPE_MAX_RETRIES', int(os.getenv('STRIPE_MAX_RETRIES', 2)))
+    app.config.setdefault('STRIPE_WEBHOOK_SECRET', os.getenv('STRIPE_WEBHOOK_SECRET'))
+
+    _settings.update(
+        api_key=os.getenv("STRIPE_SECRET_KEY"),
+        api_base=os.getenv("STRIPE_API_BASE"),
+        max_network_retries=app.config['STRIPE_MAX_RETRIES'],
+        timeout=app.config['STRIPE_TIMEOUT'],
+    )
+    # applied again on the next get_stripe()
+    _stripe = None
+
+
+def stripe_configured():
+    """True when there is a secret key, without importing stripe"""
+    return bool(_settings.get('api_key'))
+
+
+def get_stripe():
+    global _stripe
+    if _stripe is None:
+        with _lock:
+            if _stripe is None:
+                import stripe
+                stripe.api_key = _settings.get('api_key')
+                if _settings.get('api_base'):
+                    stripe.api_base = _settings['api_base']
+                # retries reuse the idempotency key, stripe answers them with the first result
+                stripe.max_network_retries = _settings.get('max_network_retries', 2)
+                stripe.default_http_client = stripe.new_default_http_client(timeout=_settings.get('timeout', 10))
+                _stripe = stripe
+    return _stripe
@@ -0,0 +1,139 @@
+"""
+Keeps a Stripe Product and Price per row of the products table, so checkout
+sends {price, quantity} pairs instead of rebuilding price_data every time.
+
+Stripe prices are immutable: a price change creates a new Price and archives
+the old one. A product needs syncing when it has no price yet or its
+stripe_price_amount no longer matches the price in cents. `flask
+stripe-sync-prices` syncs everything in batches (run it after `flask
+products`); update_product schedules the one product it changed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import select, update, func, or_, bindparam
+from api.models import db, Products
+from api.metrics import stripe_call
+from api.stripe_client import get_stripe, stripe_configured
+from api import background
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 4
+
+products_table = Products.__table__
+
+
+def price_amount(price):
+    # the cents of the price as written (1.005 -> 101, 0.125 -> 13), the same for every caller;
+    # float rounding (round() is half to even on the binary value) would not agree with itself
+    return int((Decimal(str(price)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def has_synced_price(product):
+    return bool(product.stripe_price_id) and product.stripe_price_amount == price_amount(product.price)
+
+
+def maybe_out_of_sync():
+    # a superset of the products to sync: the rounding of the database differs between dialects
+    # (and from price_amount), so it only narrows down the candidates and needs_sync decides
+    return or_(
+        Products.stripe_price_id.is_(None),
+        Products.stripe_price_amount.is_(None),
+        func.abs(Products.price * 100 - Products.stripe_price_amount) >= 0.49,
+    )
+
+
+def needs_sync(row):
+    return not row.stripe_price_id or row.stripe_price_amount != price_amount(row.price)
+
+
+def _sync_one(row):
+    # only Stripe calls here, it runs on the batch threads; the database is written by the caller
+    product_id, name, cents, stripe_product_id, old_price_id = row
+    stripe = get_stripe()
+    if not stripe_product_id:
+        with stripe_call('Product.create'):
+            stripe_product_id = stripe.Product.create(
+                name=name,
+                metadata={'product_id': str(product_id)},
+                idempotency_key=f"product-{product_id}",
+            ).id
+    with stripe_call('Price.create'):
+        price = stripe.Price.create(
+            product=stripe_product_id,
+            unit_amount=cents,
+            currency='usd',
+            metadata={'product_id': str(product_id)},
+            idempotency_key=f"price-{product_id}-{cents}-{old_price_id or 'new'}",
+        )
+    if old_price_id and old_price_id != price.id:
+        with stripe_call('Price.modify'):
+            stripe.Price.modify(old_price_id, active=False)
+    return {
+        'id': product_id,
+        'stripe_product_id': stripe_product_id,
+        'stripe_price_id': price.id,
+        'stripe_price_amount': cents,
+    }
+
+
+def sync_prices(batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, product_ids=None, report=None):
+    """
+    Syncs the products that need it, batch_size at a time: the Stripe calls of a
+    batch run on `workers` threads and the new ids are written in one commit.
+    Returns {'synced', 'failed'}.
+    """
+    synced = failed = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stripe-sync") as pool:
+        while True:
+            query = (
+                select(Products.id, Products.name, Products.price, Products.stripe_product_id, Products.stripe_price_id,
+                       Products.stripe_price_amount)
+                .where(maybe_out_of_sync(), Products.id > last_id)
+                .order_by(Products.id)
+                .limit(batch_size)
+            )
+            if product_ids is not None:
+                query = query.where(Products.id.in_(product_ids))
+            rows = db.session.execute(query).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            batch = [(row.id, row.name, price_amount(row.price), row.stripe_product_id, row.stripe_price_id)
+                     for row in rows if needs_sync(row)]
+            futures = [(row[0], pool.submit(_sync_one, row)) for row in batch]
+            values = []
+            for product_id, future in futures:
+                try:
+                    values.append(future.result())
+                except Exception as error:
+                    failed += 1
+                    print(f"ERROR: No se pudo sincronizar el precio del producto {product_id}: {error}")
+
+            if values:
+                # a plain UPDATE: a product deleted while its prices were created is skipped,
+                # the ORM bulk update would fail the whole batch on it
+                db.session.execute(
+                    update(products_table)
+                    .where(products_table.c.id == bindparam('product_id'))
+                    .values(
+                        stripe_product_id=bindparam('new_product_id'),
+                        stripe_price_id=bindparam('new_price_id'),
+                        stripe_price_amount=bindparam('new_amount'),
+                    ),
+                    [{'product_id': value['id'], 'new_product_id': value['stripe_product_id'],
+                      'new_price_id': value['stripe_price_id'], 'new_amount': value['stripe_price_amount']}
+                     for value in values],
+                )
+                db.session.commit()
+            synced += len(values)
+            if report:
+                report(synced, failed)
+    return {'synced': synced, 'failed': failed}
+
+
+def schedule_price_sync(product_id):
+    # called after the commit that changed the price
+    if stripe_configured():
+        background.submit(sync_prices, product_ids=[product_id])
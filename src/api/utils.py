@@ -1,4 +1,6 @@
-from flask import jsonify, url_for
+import base64
+import json
+from flask import jsonify, url_for, current_app, Response, stream_with_context
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +17,41 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, size):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        raise APIException("Invalid cursor", status_code=400)
+    if (not isinstance(values, list) or len(values) != size
+            or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)):
+        raise APIException("Invalid cursor", status_code=400)
+    return values
+
+def stream_json_array(items, chunk_size=200):
+    # the array is written a chunk of items at a time, so the whole list never sits in memory.
+    # items should be a generator that runs its query lazily: the view's db session is
+    # already closed when the body starts streaming
+    def generate():
+        separator = ""
+        chunk = []
+        yield "["
+        for item in items:
+            chunk.append(current_app.json.dumps(item))
+            if len(chunk) >= chunk_size:
+                yield separator + ",".join(chunk)
+                separator = ","
+                chunk = []
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
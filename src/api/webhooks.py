@@ -0,0 +1,229 @@
+"""
+Stripe webhooks: a paid Checkout session becomes an Orders row with its
+ProductsInOrder lines and a Checkout row. The lines are the stock holds of the
+session's checkout job, what the customer was charged for; only those units
+leave the cart.
+
+POST /api/stripe/webhook verifies the signature (STRIPE_WEBHOOK_SECRET),
+records the event in stripe_events keyed by the Stripe event id and answers
+right away; the order is written by a background thread. A retried delivery
+finds its event already recorded and is acknowledged without work, and the
+unique orders.stripe_session_id keeps two different events of the same
+session (completed and async_payment_succeeded) from creating two orders.
+The order commits the stock holds of its checkout; an expired session gives
+them back.
+Failed or stuck events are retried with `flask stripe-reprocess-events`.
+"""
+import json
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import select, insert, delete, update, func, bindparam
+from sqlalchemy.exc import IntegrityError
+from api.models import db, User, Products, Orders, ProductsInOrder, Checkout, ShoppingCart, StockHold, StripeEvent, utcnow
+from api.utils import APIException
+from api.cart import dialect_insert
+from api.stock import commit_job_holds, release_job_holds
+from api.stripe_client import get_stripe
+from api import background
+
+ORDER_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+# the session can no longer be paid, its stock holds go back
+RELEASE_EVENTS = ('checkout.session.expired', 'checkout.session.async_payment_failed')
+HANDLED_EVENTS = ORDER_EVENTS + RELEASE_EVENTS
+# an event still 'received' after this long lost its worker
+STUCK_AFTER = timedelta(minutes=5)
+
+cart_table = ShoppingCart.__table__
+
+
+def verify_event(payload, signature):
+    secret = current_app.config.get('STRIPE_WEBHOOK_SECRET')
+    if not secret:
+        raise APIException('Webhook secret not configured', 503)
+    stripe = get_stripe()
+    try:
+        return stripe.Webhook.construct_event(payload, signature, secret)
+    except (ValueError, stripe.SignatureVerificationError):
+        raise APIException('Invalid signature', 400)
+
+
+def record_event(event_id, event_type, payload):
+    # INSERT ... ON CONFLICT (id) DO NOTHING, no row inserted means Stripe is retrying an event we have
+    stmt = dialect_insert(StripeEvent.__table__).values(
+        id=event_id, type=event_type, payload=payload, status='received', attempts=0, received_at=utcnow(),
+    ).on_conflict_do_nothing(index_elements=['id'])
+    inserted = db.session.execute(stmt).rowcount == 1
+    db.session.commit()
+    return inserted
+
+
+def receive_event(event, payload):
+    """Records the event and schedules it, returns the body of the acknowledgement"""
+    if not record_event(event['id'], event['type'], payload):
+        status = db.session.scalar(select(StripeEvent.status).filter_by(id=event['id']))
+        # a retry of an event that failed is the cheapest moment to try it again
+        if status == 'failed':
+            background.submit(process_event, event['id'])
+        return {'received': True, 'duplicate': True, 'status': status}
+
+    if event['type'] in HANDLED_EVENTS:
+        background.submit(process_event, event['id'])
+    else:
+        _finish(event['id'], 'ignored')
+        db.session.commit()
+    return {'received': True}
+
+
+def _finish(event_id, status, error=None):
+    db.session.execute(
+        update(StripeEvent).filter_by(id=event_id)
+        .values(status=status, error=error, processed_at=utcnow(), attempts=StripeEvent.attempts + 1)
+    )
+
+
+def _postal_code(value):
+    digits = ''.join(char for char in str(value or '') if char.isdigit())
+    return int(digits[:9]) if digits else 0
+
+
+def paid_lines(checkout_job_id, user_id):
+    # what the session charged for: the stock holds of its checkout, at the price they were taken at.
+    # released holds count too, a payment that arrives after the sweeper gave the stock back was still made
+    price = func.coalesce(StockHold.price, Products.price)
+    return db.session.execute(
+        select(StockHold.product_id, func.sum(StockHold.quantity).label('quantity'), func.max(price).label('price'))
+        .join(Products, Products.id == StockHold.product_id)
+        .where(StockHold.checkout_job_id == checkout_job_id, StockHold.user_id == user_id)
+        .group_by(StockHold.product_id)
+        .order_by(StockHold.product_id)
+    ).all()
+
+
+def remove_from_cart(user_id, lines):
+    # only what was bought leaves the cart, units or products added after the checkout stay
+    db.session.execute(
+        update(cart_table)
+        .where(cart_table.c.user_id == user_id, cart_table.c.product_id == bindparam('bought_product_id'))
+        .values(quantity=cart_table.c.quantity - bindparam('bought_quantity')),
+        [{'bought_product_id': line.product_id, 'bought_quantity': line.quantity} for line in lines],
+    )
+    db.session.execute(delete(cart_table).where(cart_table.c.user_id == user_id, cart_table.c.quantity <= 0))
+
+
+def materialize_order(session, user_id):
+    """
+    Turns the checkout of the paid session into an order, in the caller's
+    transaction. Returns the order id, or None when the session already has one.
+    """
+    if db.session.scalar(select(Orders.id).filter_by(stripe_session_id=session['id'])) is not None:
+        return None
+
+    checkout_job_id = (session.get('metadata') or {}).get('checkout_job_id')
+    lines = paid_lines(checkout_job_id, user_id) if checkout_job_id else []
+    if not lines:
+        print(f"ADVERTENCIA: Sesión de pago {session['id']} sin reservas de stock, el pedido se crea sin productos")
+
+    subtotal = sum(line.price * line.quantity for line in lines)
+    amount_subtotal = session.get('amount_subtotal')
+    amount_total = session.get('amount_total')
+    address = (session.get('customer_details') or {}).get('address') or {}
+    user_address = db.session.scalar(select(User.address).filter_by(id=user_id))
+
+    order = Orders(
+        subtotal_amount=amount_subtotal / 100 if amount_subtotal is not None else subtotal,
+        total_amount=amount_total / 100 if amount_total is not None else subtotal,
+        status='paid',
+        adress=(address.get('line1') or user_address or '')[:120],
+        city=(address.get('city') or '')[:120],
+        postal_code=_postal_code(address.get('postal_code')),
+        country=(address.get('country') or '')[:120],
+        stripe_session_id=session['id'],
+    )
+    db.session.add(order)
+    db.session.flush()
+
+    if lines:
+        db.session.execute(insert(ProductsInOrder), [
+            {'order_id': order.id, 'product_id': line.product_id, 'quantity': line.quantity, 'price': line.price}
+            for line in lines
+        ])
+        remove_from_cart(user_id, lines)
+
+    # the stock was taken when the checkout started, the holds become final
+    if checkout_job_id and not commit_job_holds(checkout_job_id):
+        print(f"ADVERTENCIA: Sesión de pago {session['id']} sin reservas de stock activas")
+
+    payment_method = (session.get('payment_method_types') or ['card'])[0]
+    db.session.add(Checkout(payment_method=payment_method, status='completed', order_id=order.id, user_id=user_id))
+    return order.id
+
+
+def process_event(event_id):
+    event = db.session.get(StripeEvent, event_id)
+    if event is None or event.status in ('processed', 'ignored'):
+        return
+
+    session = json.loads(event.payload)['data']['object']
+    metadata = session.get('metadata') or {}
+    user_id = metadata.get('user_id') or session.get('client_reference_id')
+
+    if event.type in RELEASE_EVENTS:
+        if metadata.get('checkout_job_id'):
+            release_job_holds(metadata['checkout_job_id'])
+        _finish(event_id, 'processed')
+        db.session.commit()
+        return
+
+    if session.get('payment_status') not in ('paid', 'no_payment_required'):
+        # checkout.session.completed of a delayed payment method, the order waits for async_payment_succeeded
+        _finish(event_id, 'ignored', 'Payment not completed yet')
+        db.session.commit()
+        return
+    if not user_id:
+        _finish(event_id, 'ignored', 'Session without user')
+        db.session.commit()
+        return
+
+    try:
+        materialize_order(session, int(user_id))
+        _finish(event_id, 'processed')
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        # another event of the same session created the order first, any other violation
+        # (a product or user deleted since the checkout) is a failure Stripe has to retry
+        if db.session.scalar(select(Orders.id).filter_by(stripe_session_id=session['id'])) is None:
+            print(f"ERROR: No se pudo procesar el evento de Stripe {event_id}: {error}")
+            _finish(event_id, 'failed', str(error)[:500])
+            db.session.commit()
+            raise
+        _finish(event_id, 'processed')
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        print(f"ERROR: No se pudo procesar el evento de Stripe {event_id}: {error}")
+        _finish(event_id, 'failed', str(error)[:500])
+        db.session.commit()
+        raise
+
+
+def reprocess_events(event_ids=None):
+    """Runs the failed events, and those stuck in 'received', again. Returns {'processed', 'failed'}"""
+    query = select(StripeEvent.id).where(StripeEvent.type.in_(HANDLED_EVENTS)).order_by(StripeEvent.received_at)
+    if event_ids:
+        query = query.where(StripeEvent.id.in_(event_ids), StripeEvent.status.in_(('failed', 'received')))
+    else:
+        query = query.where(
+            (StripeEvent.status == 'failed')
+            | ((StripeEvent.status == 'received') & (StripeEvent.received_at < utcnow() - STUCK_AFTER))
+        )
+    result = {'processed': 0, 'failed': 0}
+    for event_id in db.session.scalars(query).all():
+        db.session.execute(update(StripeEvent).filter_by(id=event_id).values(status='received'))
+        db.session.commit()
+        try:
+            process_event(event_id)
+            result['processed'] += 1
+        except Exception:
+            result['failed'] += 1
+    return result
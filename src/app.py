@@ -4,17 +4,23 @@ This module takes care of starting the API Server, Loading the DB and Adding the
 import os
 from flask_jwt_extended import JWTManager
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, url_for, send_from_directory
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Flask, request, jsonify, url_for
 from api.utils import APIException, generate_sitemap
 from api.models import db
 from api.routes import api
 from api.admin import setup_admin
 from api.commands import setup_commands
+from api.cache import setup_cache
+from api.instrumentation import setup_instrumentation
+from api.passwords import setup_passwords
+from api.auth import setup_auth
+from api.metrics import setup_metrics
+from api.background import setup_background
+from api.stripe_client import configure_stripe
+from api.assets import setup_assets
+from api.compression import setup_compression
+from api.json_provider import setup_json
 from flask_cors import CORS
-import stripe
-
 
 # from models import Person
 
@@ -23,67 +29,92 @@ load_dotenv()
 ENV = "development" if os.getenv("FLASK_DEBUG") == "1" else "production"
 static_file_dir = os.path.join(os.path.dirname(
     os.path.realpath(__file__)), '../public/')
-app = Flask(__name__)
-CORS(app, origins=[
-    "http://localhost:3000",
-    "https://silver-enigma-v6qp6wvppvg72w9gv-3000.app.github.dev"
-], supports_credentials=True)
-app.url_map.strict_slashes = False
 
 
-app.config['JWT_SECRET_KEY'] = 'super-secret-key'
-app.config['JWT_TOKEN_LOCATION'] = ['headers']
+def create_app():
+    """Builds the app; heavy optional parts (stripe, the admin) load on first use"""
+    app = Flask(__name__)
+    # orjson (or stdlib) JSON for jsonify and request.json
+    setup_json(app)
+    CORS(app, origins=[
+        "http://localhost:3000",
+        "https://silver-enigma-v6qp6wvppvg72w9gv-3000.app.github.dev"
+    ], supports_credentials=True)
+    app.url_map.strict_slashes = False
+
+    app.config['JWT_SECRET_KEY'] = 'super-secret-key'
+    app.config['JWT_TOKEN_LOCATION'] = ['headers']
+
+    jwt = JWTManager(app)
+
+    # current_user for every protected route, cached per worker
+    setup_auth(jwt)
+
+    # stripe client: key, timeouts and retries
+    configure_stripe(app)
+
+    # database condiguration
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
+            "postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    # prometheus metrics at /metrics
+    setup_metrics(app)
+
+    # add the admin, flask_admin is only imported on the first /admin request
+    setup_admin(app)
 
-jwt = JWTManager(app)
+    # flask commands, `flask db` loads flask_migrate when it runs
+    setup_commands(app)
 
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
-print(f"DEBUGGING: stripe.api_key cargada: {stripe.api_key}") 
+    # configure the catalog caches and their invalidation broadcast
+    setup_cache(app)
 
-# database condiguration
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
-        "postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    # count the SQL statements of every request
+    setup_instrumentation(app)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db, compare_type=True)
-db.init_app(app)
+    # password hashing pool for /login and /register
+    setup_passwords(app)
 
-# add the admin
-setup_admin(app)
+    # background threads for the Stripe calls
+    setup_background(app)
 
-# add the admin
-setup_commands(app)
+    # gzip / brotli for the JSON of the api blueprint
+    setup_compression(app)
 
-# Add all endpoints form the API with a "api" prefix
-app.register_blueprint(api, url_prefix='/api')
+    # fingerprinted frontend files, scanned once
+    assets = setup_assets(app, static_file_dir)
 
-# Handle/serialize errors like a JSON object
+    # Add all endpoints form the API with a "api" prefix
+    app.register_blueprint(api, url_prefix='/api')
 
+    # Handle/serialize errors like a JSON object
+    @app.errorhandler(APIException)
+    def handle_invalid_usage(error):
+        return jsonify(error.to_dict()), error.status_code
 
-@app.errorhandler(APIException)
-def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    # generate sitemap with all your endpoints
+    @app.route('/')
+    def sitemap():
+        if ENV == "development":
+            return generate_sitemap(app)
+        return assets.send_index()
 
-# generate sitemap with all your endpoints
+    # any other endpoint will try to serve it like a static file
+    @app.route('/<path:path>', methods=['GET'])
+    def serve_any_other_file(path):
+        return assets.send(path)
 
+    return app
 
-@app.route('/')
-def sitemap():
-    if ENV == "development":
-        return generate_sitemap(app)
-    return send_from_directory(static_file_dir, 'index.html')
 
-# any other endpoint will try to serve it like a static file
-@app.route('/<path:path>', methods=['GET'])
-def serve_any_other_file(path):
-    if not os.path.isfile(os.path.join(static_file_dir, path)):
-        path = 'index.html'
-    response = send_from_directory(static_file_dir, path)
-    response.cache_control.max_age = 0  # avoid cache memory
-    return response
+app = create_app()
 
 
 # this only runs if `$ python src/main.py` is executed
@@ -152,10 +152,29 @@ export const ShoppingCart = () => {
                 // body: JSON.stringify({}) // Puedes enviar un cuerpo vacío si el backend lo requiere
             });
 
-            const data = await response.json();
+            let data = await response.json();
 
             if (!response.ok) {
-                throw new Error(data.error || `Error al crear la sesión de pago: ${response.statusText}`);
+                throw new Error(data.error || data.msg || data.message || `Error al crear la sesión de pago: ${response.statusText}`);
+            }
+
+            // 202: la sesión se crea en segundo plano, consultamos hasta que esté lista
+            let status = response.status;
+            for (let attempt = 0; status === 202 && attempt < 60; attempt++) {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const poll = await fetch(`${import.meta.env.VITE_API_URL}${data.poll_url}`, {
+                    headers: { 'Authorization': `Bearer ${token}` }
+                });
+                const pollData = await poll.json();
+                if (!poll.ok) {
+                    throw new Error(pollData.error || pollData.msg || "No se pudo iniciar el proceso de pago.");
+                }
+                status = poll.status;
+                data = { ...pollData, poll_url: data.poll_url };
+            }
+
+            if (!data.checkout_url) {
+                throw new Error("El pago está tardando demasiado, inténtalo de nuevo.");
             }
 
             // Redirige al usuario a la URL de checkout de Stripe